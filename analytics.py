@@ -0,0 +1,77 @@
+#analytics.py
+from datetime import date
+from sqlalchemy import func, literal, select, union_all
+from models import db, Section, Book, Order, Issue, Transaction, Version, ArchivedBookTotal
+from cache import TTLCache
+import versions
+
+# librarian dashboard numbers, one GROUP BY per metric. Results are cached
+# per process under the version counters of the data they are computed
+# from, so a book, issue or archive write made by any worker (or the jobs
+# process) is picked up on the next read everywhere. New orders are seen
+# through the newest transaction id instead of a counter, which every
+# checkout would have to update.
+
+ANALYTICS_TTL = 300
+
+_cache = TTLCache(maxsize=1, ttl=ANALYTICS_TTL)
+
+def _book_counts():
+    return db.session.query(Section.id, Section.name, Section.description, func.count(Book.id)) \
+        .outerjoin(Section.books).group_by(Section.id).order_by(Section.id).all()
+
+def _order_totals():
+    # orders moved to the archive are kept as per book running totals
+    lines = union_all(
+        select(Order.book_id, literal(1).label('orders'), Order.quantity.label('copies'),
+               (Order.price * Order.quantity).label('revenue')),
+        select(ArchivedBookTotal.book_id, ArchivedBookTotal.orders, ArchivedBookTotal.copies, ArchivedBookTotal.revenue),
+    ).subquery()
+    rows = db.session.query(Book.section_id, func.sum(lines.c.orders), func.sum(lines.c.copies),
+                            func.sum(lines.c.revenue)) \
+        .join(lines, lines.c.book_id == Book.id).group_by(Book.section_id).all()
+    return {section_id: (orders, copies or 0, revenue or 0) for section_id, orders, copies, revenue in rows}
+
+def _active_issues():
+    today = date.today()
+    rows = db.session.query(Book.section_id, func.count(Issue.id)) \
+        .join(Issue.orders).join(Order.book) \
+        .filter(Issue.access == True, Issue.return_date >= today) \
+        .group_by(Book.section_id).all()
+    return dict(rows)
+
+def _compute():
+    orders = _order_totals()
+    issues = _active_issues()
+    sections = []
+    for id, name, description, books in _book_counts():
+        order_count, copies, revenue = orders.get(id, (0, 0, 0))
+        sections.append({
+            'id': id,
+            'name': name,
+            'description': description,
+            'books': books,
+            'orders': order_count,
+            'copies_sold': copies,
+            'revenue': round(revenue, 2),
+            'active_issues': issues.get(id, 0),
+        })
+    return {
+        'sections': sections,
+        'totals': {
+            'books': sum(section['books'] for section in sections),
+            'orders': sum(section['orders'] for section in sections),
+            'revenue': round(sum(section['revenue'] for section in sections), 2),
+            'active_issues': sum(section['active_issues'] for section in sections),
+        },
+    }
+
+def _data_version():
+    # one statement: the counters and max(transaction.id), a primary key lookup
+    counters = (select(Version.value).where(Version.name == name).scalar_subquery()
+                for name in (versions.CATALOGUE, versions.ISSUES, versions.ARCHIVE))
+    return tuple(db.session.execute(select(*counters, select(func.max(Transaction.id)).scalar_subquery())).one())
+
+def section_stats():
+    key = (*_data_version(), date.today())
+    return _cache.get_or_set(key, _compute)
@@ -1,19 +1,237 @@
-from flask import Flask, jsonify, request, flash
-from flask_restful import Resource, Api
-from main import app
-from models import db, Section 
+from datetime import date, datetime
+from functools import wraps
+from hashlib import sha1
+from flask import Blueprint, jsonify, request, make_response
+from flask_restful import Resource, Api, abort
+from flask_login import current_user
+from models import db, Section, Book, Transaction, Order, Issue
 from routes import admin_required
+from replicas import read_only
+import search
+import versions
+
+bp = Blueprint('api', __name__)
+api = Api(bp)
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# decorator for api_auth_required, answers 401 instead of redirecting to the login page
+def api_auth_required(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401, message='Authentication required')
+        return func(*args, **kwargs)
+    return inner
+
+def to_json(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+class Collection(Resource):
+    # read-only collection with cursor pagination on id, ?fields= selection
+    # and per-resource filters. The weak ETag is built from the version
+    # counters the data depends on plus the query string, so a matching
+    # If-None-Match is answered with 304 before any rows are loaded.
+    method_decorators = [api_auth_required, read_only]
+    name = None
+    fields = {}
+    default_fields = None
+
+    def versions(self):
+        return (versions.CATALOGUE,)
+
+    def scope(self, query):
+        return query
+
+    def filter(self, query, args):
+        return query
+
+    def etag(self):
+        parts = [self.name, *versions.get_many(*self.versions()), sorted(request.args.items(multi=True))]
+        return sha1(repr(parts).encode()).hexdigest()
+
+    def selected_fields(self):
+        requested = request.args.get('fields')
+        if not requested:
+            return list(self.default_fields or self.fields)
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            abort(400, message=f'Unknown fields: {", ".join(unknown)}')
+        return names
+
+    def limit(self):
+        try:
+            limit = int(request.args.get('limit') or DEFAULT_LIMIT)
+        except ValueError:
+            abort(400, message='Invalid limit')
+        return max(1, min(limit, MAX_LIMIT))
+
+    def cursor(self):
+        cursor = request.args.get('cursor')
+        if not cursor:
+            return None
+        try:
+            return int(cursor)
+        except ValueError:
+            abort(400, message='Invalid cursor')
 
-api = Api(app) 
-class GetSection(Resource):
-    @admin_required
     def get(self):
-        sections = Section.query.all()
-        flash('Section data retrieved successfully.', 'info')
-        return jsonify({'sections': [{
-            'id': section.id,
-            'name': section.name
-            } for section in sections]
-        })
-    
+        etag = self.etag()
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        names = self.selected_fields()
+        id_column = self.fields['id']
+        query = db.session.query(id_column, *[self.fields[name] for name in names])
+        query = self.filter(self.scope(query), request.args)
+        cursor = self.cursor()
+        if cursor is not None:
+            query = query.filter(id_column > cursor)
+        limit = self.limit()
+        rows = query.order_by(id_column).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = str(rows[-1][0])
+        items = [{name: to_json(value) for name, value in zip(names, row[1:])} for row in rows]
+
+        response = jsonify({self.name: items, 'next_cursor': next_cursor})
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+def float_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        abort(400, message=f'Invalid {name}')
+
+def int_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, message=f'Invalid {name}')
+
+class Sections(Collection):
+    name = 'sections'
+    fields = {
+        'id': Section.id,
+        'name': Section.name,
+        'description': Section.description,
+        'date_created': Section.date_created,
+    }
+
+    def filter(self, query, args):
+        if args.get('name'):
+            query = query.filter(Section.name.ilike(f"%{args['name']}%"))
+        return query
+
+class Books(Collection):
+    name = 'books'
+    fields = {
+        'id': Book.id,
+        'name': Book.name,
+        'author': Book.author,
+        'content': Book.content,
+        'price': Book.price,
+        'section_id': Book.section_id,
+        # not available: it moves with every checkout, the ETag only with the catalogue
+        'copies': Book.copies,
+    }
+
+    def filter(self, query, args):
+        section_id = int_arg(args, 'section_id')
+        if section_id is not None:
+            query = query.filter(Book.section_id == section_id)
+        if args.get('author'):
+            query = query.filter(Book.author == args['author'])
+        min_price = float_arg(args, 'min_price')
+        if min_price is not None:
+            query = query.filter(Book.price >= min_price)
+        max_price = float_arg(args, 'max_price')
+        if max_price is not None:
+            query = query.filter(Book.price <= max_price)
+        q = (args.get('q') or '').strip()
+        if q and search.enabled():
+            query = query.filter(Book.id.in_(search.book_ids_matching(q)))
+        elif q:
+            query = query.filter(Book.name.ilike(f'%{q}%'))
+        return query
+
+class Orders(Collection):
+    name = 'orders'
+    fields = {
+        'id': Order.id,
+        'transaction_id': Order.transaction_id,
+        'book_id': Order.book_id,
+        'quantity': Order.quantity,
+        'price': Order.price,
+        'datetime': Transaction.datetime,
+    }
+
+    def versions(self):
+        return (versions.user_key(current_user.id), versions.ARCHIVE)
+
+    def scope(self, query):
+        return query.join(Transaction, Order.transaction_id == Transaction.id).filter(Transaction.user_id == current_user.id)
+
+    def filter(self, query, args):
+        transaction_id = int_arg(args, 'transaction_id')
+        if transaction_id is not None:
+            query = query.filter(Order.transaction_id == transaction_id)
+        book_id = int_arg(args, 'book_id')
+        if book_id is not None:
+            query = query.filter(Order.book_id == book_id)
+        return query
+
+class Issues(Collection):
+    name = 'issues'
+    fields = {
+        'id': Issue.id,
+        'order_id': Issue.order_id,
+        'issue': Issue.issue,
+        'return_date': Issue.return_date,
+        'access': Issue.access,
+    }
+
+    def versions(self):
+        return (versions.user_key(current_user.id), versions.ISSUES, versions.ARCHIVE)
+
+    def etag(self):
+        # "active" depends on today's date as well as on the data
+        return sha1(f'{super().etag()}:{date.today()}'.encode()).hexdigest()
+
+    def scope(self, query):
+        return query.filter(Issue.user_id == current_user.id)
+
+    def filter(self, query, args):
+        active = args.get('active')
+        if active in ('1', 'true'):
+            query = query.filter(Issue.access == True, Issue.return_date >= date.today())
+        elif active in ('0', 'false'):
+            query = query.filter((Issue.access == False) | (Issue.return_date < date.today()))
+        return query
+
+class GetSection(Sections):
+    # original endpoint, admin only and id/name by default
+    method_decorators = [admin_required, read_only]
+    default_fields = ('id', 'name')
+
 api.add_resource(GetSection, '/api/section/get', methods=['GET'])
+api.add_resource(Sections, '/api/sections')
+api.add_resource(Books, '/api/books')
+api.add_resource(Orders, '/api/orders')
+api.add_resource(Issues, '/api/issues')
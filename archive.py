@@ -0,0 +1,209 @@
+#archive.py
+import json
+import zlib
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, update, delete, and_, or_, exists, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, defer, joinedload
+from models import db, Book, Transaction, Order, Payment, Issue, ArchivedTransaction, ArchivedBookTotal
+import versions
+
+# moves transactions older than ARCHIVE_AFTER_DAYS, with their orders,
+# payment and issues, out of the hot tables into archive_transaction (one
+# compressed row per transaction). A transaction stays hot while one of its
+# issues is active or its payment is pending. The orders and issues pages
+# page through hot rows and the archive together, newest first, so older
+# history is one "load older" click away and the hot tables only hold
+# recent activity.
+
+ARCHIVE_BATCH = 500
+PAGE_SIZE = 20
+
+ArchivedBook = namedtuple('ArchivedBook', 'id name downloadable')
+ArchivedOrder = namedtuple('ArchivedOrder', 'id book_id book quantity price')
+ArchivedIssue = namedtuple('ArchivedIssue', 'id order_id issue return_date access orders')
+Archived = namedtuple('Archived', 'id datetime subtotal gst amount_payable item_count orders payment issues')
+
+def _archivable(cutoff):
+    active_issue = exists().where(Issue.order_id == Order.id, Order.transaction_id == Transaction.id,
+                                  Issue.access == True)
+    pending_payment = exists().where(Payment.transaction_id == Transaction.id, Payment.status == 'pending')
+    # the newest transaction always stays: SQLite hands out max(rowid) + 1,
+    # so deleting it would give the next checkout an id already archived
+    newest = select(func.max(Transaction.id)).scalar_subquery()
+    return select(Transaction.id).where(Transaction.datetime < cutoff, Transaction.id < newest,
+                                        ~active_issue, ~pending_payment) \
+        .order_by(Transaction.id).limit(ARCHIVE_BATCH)
+
+def _encode(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':'), default=str).encode())
+
+def _add_book_totals(totals):
+    for book_id, (orders, copies, revenue) in totals.items():
+        statement = update(ArchivedBookTotal).where(ArchivedBookTotal.book_id == book_id).values(
+            orders=ArchivedBookTotal.orders + orders, copies=ArchivedBookTotal.copies + copies,
+            revenue=ArchivedBookTotal.revenue + revenue)
+        if db.session.execute(statement).rowcount:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(ArchivedBookTotal), {'book_id': book_id, 'orders': orders,
+                                                               'copies': copies, 'revenue': revenue})
+        except IntegrityError:
+            db.session.execute(statement)
+
+def _archive_batch(ids, now):
+    transactions = db.session.execute(select(Transaction.__table__).where(Transaction.id.in_(ids))).mappings().all()
+    orders = db.session.execute(
+        select(Order.id, Order.transaction_id, Order.book_id, Book.name, Order.quantity, Order.price)
+        .join(Book, Order.book_id == Book.id).where(Order.transaction_id.in_(ids))
+    ).all()
+    payments = db.session.execute(select(Payment.__table__).where(Payment.transaction_id.in_(ids))).mappings().all()
+    issues = db.session.execute(
+        select(Issue.id, Issue.order_id, Issue.issue, Issue.return_date, Issue.access, Order.transaction_id)
+        .join(Order, Issue.order_id == Order.id).where(Order.transaction_id.in_(ids))
+    ).all()
+
+    content = {id: {'orders': [], 'payment': None, 'issues': []} for id in ids}
+    totals = {}
+    for id, transaction_id, book_id, name, quantity, price in orders:
+        content[transaction_id]['orders'].append(
+            {'id': id, 'book_id': book_id, 'book': name, 'quantity': quantity, 'price': price})
+        count, copies, revenue = totals.get(book_id, (0, 0, 0))
+        totals[book_id] = (count + 1, copies + quantity, revenue + price * quantity)
+    for payment in payments:
+        content[payment['transaction_id']]['payment'] = {key: payment[key] for key in
+                                                         ('id', 'total', 'gst', 'amount_payable', 'status', 'datetime')}
+    for id, order_id, issued, return_date, access, transaction_id in issues:
+        content[transaction_id]['issues'].append(
+            {'id': id, 'order_id': order_id, 'issue': issued, 'return_date': return_date, 'access': bool(access)})
+
+    db.session.execute(insert(ArchivedTransaction), [{
+        'id': row['id'], 'user_id': row['user_id'], 'datetime': row['datetime'],
+        'period': row['datetime'].strftime('%Y-%m'), 'subtotal': row['subtotal'], 'gst': row['gst'],
+        'amount_payable': row['amount_payable'], 'item_count': row['item_count'],
+        'data': _encode(content[row['id']]), 'archived': now,
+    } for row in transactions])
+    _add_book_totals(totals)
+
+    order_ids = [row[0] for row in orders]
+    options = {'synchronize_session': False}
+    db.session.execute(delete(Issue).where(Issue.order_id.in_(order_ids)), execution_options=options)
+    db.session.execute(delete(Order).where(Order.transaction_id.in_(ids)), execution_options=options)
+    db.session.execute(delete(Payment).where(Payment.transaction_id.in_(ids)), execution_options=options)
+    db.session.execute(delete(Transaction).where(Transaction.id.in_(ids)), execution_options=options)
+    versions.bump(versions.ARCHIVE)
+
+def archive_old_transactions(days=None, now=None):
+    days = current_app.config.get('ARCHIVE_AFTER_DAYS', 0) if days is None else days
+    if not days:
+        return 0
+    now = now or datetime.now()
+    statement = _archivable(now - timedelta(days=days))
+    archived = 0
+    while True:
+        ids = db.session.execute(statement).scalars().all()
+        if not ids:
+            break
+        try:
+            _archive_batch(ids, now)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        archived += len(ids)
+    return archived
+
+def _decode(row):
+    content = json.loads(zlib.decompress(row.data))
+    orders = {order['id']: ArchivedOrder(order['id'], order['book_id'], ArchivedBook(order['book_id'], order['book'], False),
+                                         order['quantity'], order['price'])
+              for order in content['orders']}
+    issues = [ArchivedIssue(issue['id'], issue['order_id'], date.fromisoformat(issue['issue']),
+                            date.fromisoformat(issue['return_date']), issue['access'], orders.get(issue['order_id']))
+              for issue in content['issues']]
+    return Archived(row.id, row.datetime, row.subtotal, row.gst, row.amount_payable, row.item_count,
+                    list(orders.values()), content['payment'], issues)
+
+def _archived(user_id, before, limit):
+    query = ArchivedTransaction.query.filter(ArchivedTransaction.user_id == user_id)
+    if before:
+        query = query.filter(ArchivedTransaction.id <= before)
+    return [_decode(row) for row in query.order_by(ArchivedTransaction.id.desc()).limit(limit)]
+
+def _position(cursor):
+    try:
+        return tuple(int(part) for part in cursor.split('-')) if cursor else None
+    except ValueError:
+        return None
+
+def order_page(user_id, before=None, limit=PAGE_SIZE):
+    # newest first across the hot table and the archive; `before` is the
+    # id of the last transaction shown. Returns (transactions, next cursor).
+    # Only the stored totals are read, two queries however many lines the
+    # orders have; order_lines() loads the lines of one transaction.
+    position = _position(before)
+    before = position[0] if position else None
+    query = Transaction.query.filter_by(user_id=user_id)
+    cold = ArchivedTransaction.query.filter_by(user_id=user_id).options(defer(ArchivedTransaction.data))
+    if before:
+        query = query.filter(Transaction.id < before)
+        cold = cold.filter(ArchivedTransaction.id < before)
+    hot = query.order_by(Transaction.id.desc()).limit(limit + 1).all()
+    cold = cold.order_by(ArchivedTransaction.id.desc()).limit(limit + 1).all()
+    rows = sorted(hot + cold, key=lambda row: row.id, reverse=True)
+    page = rows[:limit]
+    return page, (str(page[-1].id) if len(rows) > limit else None)
+
+def order_lines(user_id, transaction_id):
+    # the orders of one of the user's transactions, hot or archived
+    lines = Order.query.join(Transaction, Order.transaction_id == Transaction.id) \
+        .filter(Transaction.id == transaction_id, Transaction.user_id == user_id) \
+        .options(joinedload(Order.book)).order_by(Order.id).all()
+    if lines:
+        return lines
+    row = ArchivedTransaction.query.filter_by(id=transaction_id, user_id=user_id).first()
+    return _decode(row).orders if row else []
+
+def issue_page(user_id, before=None, limit=PAGE_SIZE):
+    # issues ordered by (transaction, issue) newest first; the cursor is
+    # "<transaction id>-<issue id>" of the last issue shown
+    position = _position(before)
+    position = position if position and len(position) == 2 else None
+    query = Issue.query.join(Issue.orders).filter(Issue.user_id == user_id) \
+        .options(contains_eager(Issue.orders).joinedload(Order.book))
+    if position:
+        transaction_id, issue_id = position
+        query = query.filter(or_(Order.transaction_id < transaction_id,
+                                 and_(Order.transaction_id == transaction_id, Issue.id < issue_id)))
+    hot = [(issue.orders.transaction_id, issue) for issue in
+           query.order_by(Order.transaction_id.desc(), Issue.id.desc()).limit(limit + 1)]
+
+    # deleting a book takes its orders and issues along, so an archived
+    # transaction can have no issues; read on until there are enough
+    cold = []
+    upto = position[0] if position else None
+    while len(cold) <= limit:
+        transactions = _archived(user_id, upto, limit + 1)
+        for transaction in transactions:
+            for issue in sorted(transaction.issues, key=lambda issue: issue.id, reverse=True):
+                if not position or (transaction.id, issue.id) < position:
+                    cold.append((transaction.id, issue))
+        if len(transactions) <= limit:
+            break
+        upto = transactions[-1].id - 1
+    rows = sorted(hot + cold, key=lambda row: (row[0], row[1].id), reverse=True)
+    page = rows[:limit]
+    next_cursor = f'{page[-1][0]}-{page[-1][1].id}' if len(rows) > limit else None
+    return [issue for transaction_id, issue in page], next_cursor
+
+@click.command('archive')
+@click.option('--days', type=int, default=None, help='Archive transactions older than this (default ARCHIVE_AFTER_DAYS).')
+@with_appcontext
+def archive_command(days):
+    """Move old transactions, orders, payments and issues into the archive."""
+    print(f'Archived {archive_old_transactions(days)} transactions')
@@ -0,0 +1,334 @@
+#benchmark.py
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+
+# benchmark for the core user journey:
+#   login -> user_dash search -> add_to_cart -> checkout -> payments -> orders
+# against a synthetic library seeded into a temporary SQLite database.
+#
+#   python benchmark.py                          # Flask test client, one journey at a time
+#   python benchmark.py --mode http -c 8         # local threaded HTTP server, 8 concurrent users
+#   python benchmark.py --check                  # exit 1 if worse than benchmark_baseline.json
+#   python benchmark.py --save-baseline          # record the current numbers as the baseline
+#
+# Queries per request come from the Server-Timing header, so both modes
+# measure exactly what the app reports. Latency varies between machines,
+# the query counts do not: --tolerance only applies to timings.
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+STEPS = ['login', 'search', 'add_to_cart', 'checkout', 'payments', 'orders']
+PASSWORD = 'benchmark'
+WORDS = ['river', 'glass', 'north', 'shadow', 'garden', 'iron', 'silent', 'paper', 'winter', 'copper',
+         'harbor', 'stone', 'amber', 'hollow', 'signal', 'orchard', 'lantern', 'meadow', 'ember', 'atlas']
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+def configure_environment(directory):
+    # config.py reads the environment when it is imported
+    os.environ.update({
+        'APP_ENV': 'dev',
+        'SECRET_KEY': os.environ.get('SECRET_KEY') or 'benchmark',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'benchmark.sqlite3'),
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        'FRAGMENT_CACHE_DIR': os.path.join(directory, 'fragments'),
+        'BOOTSTRAP_ON_START': 'true',
+        'QUERY_BUDGET_STRICT': 'true',  # a view over its budget is an HTTP 500 and fails the run
+        'SCHEDULER_ENABLED': 'false',
+        'SERVER_TIMING': 'true',
+        'SLOW_QUERY_MS': '0',
+        # every simulated user logs in from 127.0.0.1
+        'RATELIMIT_ENABLED': 'false',
+    })
+
+def seed(app, sections, books, users, history, rng):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from models import db, User, Section, Book, Transaction, Order, Issue, Payment, Version
+    from billing import payment_values, transaction_summary
+    import search
+    import versions
+
+    with app.app_context():
+        today = datetime.now()
+        db.session.execute(insert(Section), [
+            {'id': i, 'name': f'Section {i}', 'description': f'{rng.choice(WORDS)} collection',
+             'date_created': today.date()}
+            for i in range(1, sections + 1)
+        ])
+        db.session.execute(insert(Book), [
+            {'id': i, 'name': f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}',
+             'content': ' '.join(rng.choice(WORDS) for _ in range(30)), 'author': f'Author {rng.randint(1, 200)}',
+             'price': rng.randint(50, 900), 'section_id': rng.randint(1, sections)}
+            for i in range(1, books + 1)
+        ])
+        # hashing is deliberately slow, every benchmark user shares one hash
+        passhash = generate_password_hash(PASSWORD)
+        user_ids = db.session.execute(insert(User).returning(User.id), [
+            {'username': f'reader{i}', 'passhash': passhash, 'name': f'Reader {i}', 'is_admin': False}
+            for i in range(1, users + 1)
+        ]).scalars().all()
+
+        transactions, orders, issues, payments = [], [], [], []
+        for user_id in user_ids:
+            for _ in range(history):
+                when = today - timedelta(days=rng.randint(8, 365))
+                transaction_id = len(transactions) + 1
+                lines = []
+                for book_id in rng.sample(range(1, books + 1), rng.randint(1, 3)):
+                    price = rng.randint(50, 900)
+                    lines.append((price, 1))
+                    orders.append({'id': len(orders) + 1, 'transaction_id': transaction_id, 'book_id': book_id,
+                                   'quantity': 1, 'price': price})
+                    issues.append({'user_id': user_id, 'order_id': len(orders), 'issue': when.date(),
+                                   'return_date': (when + timedelta(days=7)).date(), 'access': False})
+                summary = transaction_summary(lines)
+                transactions.append({'id': transaction_id, 'user_id': user_id, 'datetime': when, **summary})
+                payment = payment_values(user_id, transaction_id, summary)
+                payment.update(status='paid', datetime=when)
+                payments.append(payment)
+        # users with history already have their version counter, like checkout would have left it
+        counters = [{'name': versions.user_key(user_id), 'value': history} for user_id in user_ids] if history else []
+        for model, rows in ((Transaction, transactions), (Order, orders), (Issue, issues), (Payment, payments),
+                            (Version, counters)):
+            if rows:
+                db.session.execute(insert(model), rows)
+        db.session.commit()
+        search.rebuild()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {step: [] for step in STEPS}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, step, seconds, status, expected, server_timing):
+        match = QUERIES.search(server_timing or '')
+        with self._lock:
+            self.samples[step].append((seconds, int(match.group(1)) if match else 0))
+            if status not in expected:
+                self.errors.append(f'{step}: HTTP {status}')
+
+    def summary(self, wall_seconds, journeys):
+        steps = {}
+        for step, samples in self.samples.items():
+            timings = [seconds * 1000 for seconds, queries in samples]
+            steps[step] = {
+                'count': len(samples),
+                'p50_ms': round(percentile(timings, 0.50), 2),
+                'p99_ms': round(percentile(timings, 0.99), 2),
+                'mean_ms': round(sum(timings) / len(timings), 2) if timings else 0.0,
+                'queries': round(sum(queries for seconds, queries in samples) / len(samples), 2) if samples else 0.0,
+            }
+        requests = sum(step['count'] for step in steps.values())
+        return {
+            'steps': steps,
+            'requests': requests,
+            'journeys': journeys,
+            'errors': len(self.errors),
+            'wall_seconds': round(wall_seconds, 3),
+            'requests_per_second': round(requests / wall_seconds, 1) if wall_seconds else 0.0,
+            'journeys_per_second': round(journeys / wall_seconds, 2) if wall_seconds else 0.0,
+        }
+
+class ClientSession:
+    # Flask test client, in process
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get('Location'), response.headers.get('Server-Timing')
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HTTPSession:
+    # one cookie jar per simulated user, redirects are measured as their own requests
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status, response.headers.get('Location'), response.headers.get('Server-Timing')
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('Location'), error.headers.get('Server-Timing')
+
+def journey(session, recorder, user_id, books, rng):
+    def step(name, method, path, expected, data=None):
+        start = time.perf_counter()
+        status, location, server_timing = session.request(method, path, data)
+        recorder.add(name, time.perf_counter() - start, status, expected, server_timing)
+        return location
+
+    step('login', 'POST', '/login', (302,), {'userName': f'reader{user_id}', 'password': PASSWORD})
+    step('search', 'GET', '/user_dash?' + urllib.parse.urlencode({'bname': rng.choice(WORDS)}), (200,))
+    step('add_to_cart', 'POST', f'/add_to_cart/{rng.randint(1, books)}', (302,), {'quantity': 1})
+    location = step('checkout', 'POST', '/checkout', (302,), {})
+    payment_path = urllib.parse.urlsplit(location or '').path
+    if payment_path.startswith('/payments/'):
+        step('payments', 'GET', payment_path, (200,))
+    step('orders', 'GET', '/orders', (200,))
+    session.request('GET', '/logout')
+
+def run_client(app, args, rng):
+    recorder = Recorder()
+    start = time.perf_counter()
+    for i in range(args.journeys):
+        journey(ClientSession(app), recorder, i % args.users + 1, args.books, rng)
+    return recorder.summary(time.perf_counter() - start, args.journeys), recorder
+
+def run_http(app, args, rng):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    concurrency = min(args.concurrency, args.users)
+    recorder = Recorder()
+
+    def worker(index):
+        # users are split between workers, two workers never share a cart
+        worker_rng = random.Random(rng.random())
+        users = list(range(index + 1, args.users + 1, concurrency))
+        for i in range(index, args.journeys, concurrency):
+            journey(HTTPSession(base_url), recorder, users[(i // concurrency) % len(users)], args.books, worker_rng)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(concurrency)))
+    finally:
+        server.shutdown()
+    return recorder.summary(time.perf_counter() - start, args.journeys), recorder
+
+def compare(result, baseline, tolerance, floor_ms):
+    # returns the list of regressions against one baseline entry
+    problems = []
+    for step, base in baseline['steps'].items():
+        current = result['steps'].get(step)
+        if not current or not current['count']:
+            problems.append(f'{step}: no samples')
+            continue
+        if current['queries'] > base['queries']:
+            problems.append(f'{step}: {current["queries"]} queries per request, baseline {base["queries"]}')
+        for key in ('p50_ms', 'p99_ms'):
+            limit = max(base[key] * (1 + tolerance), base[key] + floor_ms)
+            if current[key] > limit:
+                problems.append(f'{step}: {key} {current[key]} over limit {limit:.2f} (baseline {base[key]})')
+    if result['requests_per_second'] < baseline['requests_per_second'] / (1 + tolerance):
+        problems.append(f'throughput {result["requests_per_second"]} req/s, baseline {baseline["requests_per_second"]}')
+    return problems
+
+def print_report(result, mode):
+    print(f'{mode}: {result["journeys"]} journeys, {result["requests"]} requests in {result["wall_seconds"]}s '
+          f'({result["requests_per_second"]} req/s, {result["journeys_per_second"]} journeys/s), '
+          f'{result["errors"]} errors')
+    print(f'{"step":<12} {"count":>6} {"p50 ms":>9} {"p99 ms":>9} {"mean ms":>9} {"queries":>8}')
+    for step, row in result['steps'].items():
+        print(f'{step:<12} {row["count"]:>6} {row["p50_ms"]:>9} {row["p99_ms"]:>9} {row["mean_ms"]:>9} {row["queries"]:>8}')
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the login to orders user journey.')
+    parser.add_argument('--mode', choices=['client', 'http'], default='client')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='simultaneous users in http mode')
+    parser.add_argument('--journeys', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10, help='journeys run before measuring')
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--history', type=int, default=20, help='past transactions per user')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--check', action='store_true', help='exit 1 on a regression against the baseline')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed relative slowdown, 1.0 = twice as slow')
+    parser.add_argument('--floor-ms', type=float, default=5.0, help='slowdowns below this many ms are ignored')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary database')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    directory = tempfile.mkdtemp(prefix='library-benchmark-')
+    configure_environment(directory)
+    try:
+        from main import create_app
+        app = create_app()
+        rng = random.Random(args.seed)
+        seed(app, args.sections, args.books, args.users, args.history, rng)
+
+        run = run_http if args.mode == 'http' else run_client
+        if args.warmup:
+            run(app, argparse.Namespace(**{**vars(args), 'journeys': args.warmup}), random.Random(0))
+        result, recorder = run(app, args, rng)
+        result['dataset'] = {key: getattr(args, key) for key in ('sections', 'books', 'users', 'history', 'seed')}
+        print_report(result, args.mode)
+        for error in recorder.errors[:10]:
+            print('error:', error)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        if args.save_baseline:
+            baselines[args.mode] = result
+            with open(args.baseline, 'w') as f:
+                json.dump(baselines, f, indent=2)
+                f.write('\n')
+            print(f'Saved {args.mode} baseline to {args.baseline}')
+
+        if recorder.errors:
+            return 1
+        if args.check:
+            if args.mode not in baselines:
+                print(f'No {args.mode} baseline in {args.baseline}')
+                return 1
+            if baselines[args.mode].get('dataset') != result['dataset']:
+                print('warning: dataset differs from the baseline, timings are not comparable')
+            problems = compare(result, baselines[args.mode], args.tolerance, args.floor_ms)
+            for problem in problems:
+                print('regression:', problem)
+            if problems:
+                return 1
+            print('No regressions')
+        return 0
+    finally:
+        if args.keep:
+            print(f'Database kept in {directory}')
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#billing.py
+from datetime import datetime
+from sqlalchemy import case, func, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, Payment, Transaction, Order
+
+GST_RATE = 0.18
+
+# one Payment per transaction (payment.transaction_id is unique). It is
+# written once, normally by checkout, and every later view reads it back.
+
+def transaction_summary(lines):
+    # lines are (price, quantity) pairs at the price charged
+    subtotal = sum(price * quantity for price, quantity in lines)
+    GST = round(subtotal * GST_RATE, 2)
+    return {
+        'subtotal': subtotal,
+        'gst': GST,
+        'amount_payable': round(subtotal + GST, 2),
+        'item_count': sum(quantity for price, quantity in lines),
+    }
+
+def payment_values(user_id, transaction_id, summary):
+    # summary is the transaction_summary the transaction was stored with
+    return {
+        'user_id': user_id,
+        'transaction_id': transaction_id,
+        'total': summary['subtotal'],
+        'gst': summary['gst'],
+        'amount_payable': summary['amount_payable'],
+        'status': 'pending',
+        'datetime': datetime.now(),
+    }
+
+def get_payment(user_id, transaction_id):
+    # one statement whether the payment exists, the transaction is unknown
+    # or it is an old transaction still without a payment; the order sum
+    # is only evaluated for old transactions that have no stored subtotal
+    order_total = select(func.coalesce(func.sum(Order.price * Order.quantity), 0)) \
+        .where(Order.transaction_id == Transaction.id).scalar_subquery()
+    row = db.session.query(Payment, Transaction.subtotal, Transaction.gst, Transaction.amount_payable,
+                           case((Transaction.subtotal.is_(None), order_total))).select_from(Transaction) \
+        .outerjoin(Payment, Payment.transaction_id == Transaction.id) \
+        .filter(Transaction.id == transaction_id, Transaction.user_id == user_id).first()
+    if row is None:
+        return None
+    payment, subtotal, gst, amount_payable, order_total = row
+    if payment:
+        return payment
+    if subtotal is None:
+        summary = transaction_summary([(order_total, 1)])
+    else:
+        summary = {'subtotal': subtotal, 'gst': gst, 'amount_payable': amount_payable}
+    return _create_payment(user_id, transaction_id, summary)
+
+def _create_payment(user_id, transaction_id, summary):
+    # transactions from before payments were written at checkout
+    payment = Payment(**payment_values(user_id, transaction_id, summary))
+    db.session.add(payment)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request created it first
+        db.session.rollback()
+        payment = Payment.query.filter_by(transaction_id=transaction_id, user_id=user_id).first()
+    return payment
+
+def confirm_payment(user_id, transaction_id):
+    # conditional update, so retries and double submits are no-ops
+    result = db.session.execute(
+        update(Payment)
+        .where(Payment.transaction_id == transaction_id, Payment.user_id == user_id, Payment.status == 'pending')
+        .values(status='success', datetime=datetime.now())
+    )
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,62 @@
+#bootstrap.py
+import click
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+from models import db, User
+import archive
+import migrations
+import replicas
+import search
+import storage
+import versions
+
+# one-off database setup: schema, pending migrations, search index and the
+# librarian account. Run it once per deploy with `flask bootstrap`; the dev
+# profile also runs it when the app is created (BOOTSTRAP_ON_START), except
+# for flask commands other than `flask run`, so `flask db-version` and
+# `flask db-upgrade` see the database as it is.
+
+def seed_admin():
+    # if admin exists, else create admin
+    admin = User.query.filter_by(is_admin=True).first()
+    if not admin:
+        password_hash = generate_password_hash('admin')
+        admin = User(username='librarian', passhash=password_hash, name='Librarian', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+    return admin
+
+def bootstrap():
+    # the primary only, replicas are copies of it
+    db.create_all(bind_key=None)
+    applied = migrations.upgrade()
+    search.create_index()
+    versions.seed()
+    seed_admin()
+    return applied
+
+def _cli_command():
+    # the app is built while the flask CLI resolves or runs a command
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.command.name != 'run'
+
+@click.command('bootstrap')
+@with_appcontext
+def bootstrap_command():
+    """Create the schema, apply migrations, build the search index and seed the librarian."""
+    applied = bootstrap()
+    if applied:
+        print(f'Applied migrations {", ".join(map(str, applied))}')
+    print('Database ready')
+
+def init_app(app):
+    app.cli.add_command(bootstrap_command)
+    app.cli.add_command(migrations.db_upgrade_command)
+    app.cli.add_command(migrations.db_version_command)
+    app.cli.add_command(search.search_rebuild_command)
+    app.cli.add_command(storage.storage_prune_command)
+    app.cli.add_command(archive.archive_command)
+    app.cli.add_command(replicas.sync_replicas_command)
+    if app.config.get('BOOTSTRAP_ON_START') and not _cli_command():
+        with app.app_context():
+            bootstrap()
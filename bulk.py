@@ -0,0 +1,189 @@
+#bulk.py
+import csv
+import io
+import math
+from datetime import datetime
+from sqlalchemy import select, insert
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Section, Book, DEFAULT_COPIES
+import search
+
+# streaming CSV import/export for books and sections. Imports read the
+# upload row by row and insert CHUNK_SIZE rows per statement, committing
+# each chunk; exports stream rows from a server-side cursor. Memory stays
+# flat whatever the file size. Bad rows, a file that stops being readable
+# CSV and chunks the database refuses all end up in the report with their
+# line numbers; the chunks committed before them stay.
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 500
+
+BOOK_COLUMNS = ['id', 'name', 'content', 'author', 'price', 'section_id', 'section', 'copies']
+SECTION_COLUMNS = ['id', 'name', 'description', 'date_created']
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message, count=1):
+        self.failed += count
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def as_dict(self):
+        return {'inserted': self.inserted, 'failed': self.failed, 'errors': self.errors,
+                'errors_truncated': self.failed > len(self.errors)}
+
+def _decode(stream):
+    # line by line, so an encoding error is pinned to the line it is on
+    for number, raw in enumerate(stream, start=1):
+        yield raw.decode('utf-8-sig' if number == 1 else 'utf-8')
+
+def read_rows(stream, report):
+    # line numbers count the header as line 1, like a spreadsheet
+    reader = csv.DictReader(_decode(stream))
+    try:
+        for line, row in enumerate(reader, start=2):
+            yield line, {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+    except UnicodeDecodeError:
+        report.error(reader.line_num + 1, 'Not UTF-8 text, the rest of the file was not read')
+    except csv.Error as error:
+        report.error(reader.line_num, f'Invalid CSV ({error}), the rest of the file was not read')
+
+def validate_book(row, section_ids, section_names):
+    # same rules as add_book_post
+    name, content, author, price = row.get('name'), row.get('content'), row.get('author'), row.get('price')
+    if not name or not content or not author or not price:
+        return None, 'Please fill out all fields'
+    try:
+        price = float(price)
+    except ValueError:
+        return None, 'Invalid price'
+    if not math.isfinite(price) or price <= 0:
+        return None, 'Invalid price'
+
+    section_id = row.get('section_id')
+    if section_id:
+        try:
+            section_id = int(section_id)
+        except ValueError:
+            return None, 'Invalid section_id'
+        if section_id not in section_ids:
+            return None, 'Section does not exist'
+    elif row.get('section') in section_names:
+        section_id = section_names[row['section']]
+    else:
+        return None, 'Section does not exist'
+
+    copies = row.get('copies') or DEFAULT_COPIES
+    try:
+        copies = int(copies)
+    except ValueError:
+        return None, 'Invalid copies'
+    if copies < 0:
+        return None, 'Invalid copies'
+    return {'name': name, 'content': content, 'author': author, 'price': price, 'section_id': section_id,
+            'copies': copies, 'available': copies}, None
+
+def _flush(chunk, lines, report, write):
+    try:
+        report.inserted += write(chunk)
+        db.session.commit()
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        report.error(lines[0], f'Lines {lines[0]}-{lines[-1]} were not saved: {getattr(error, "orig", error)}',
+                     count=len(chunk))
+
+def _write_books(chunk):
+    rows = db.session.execute(
+        insert(Book).returning(Book.id, Book.name, Book.author, Book.content), chunk
+    ).all()
+    search.index_books(rows)
+    return len(rows)
+
+def import_books(stream):
+    report = ImportReport()
+    sections = db.session.execute(select(Section.id, Section.name)).all()
+    section_ids = {id for id, name in sections}
+    section_names = {name: id for id, name in sections}
+    chunk, lines = [], []
+    for line, row in read_rows(stream, report):
+        book, error = validate_book(row, section_ids, section_names)
+        if error:
+            report.error(line, error)
+            continue
+        chunk.append(book)
+        lines.append(line)
+        if len(chunk) >= CHUNK_SIZE:
+            _flush(chunk, lines, report, _write_books)
+            chunk, lines = [], []
+    if chunk:
+        _flush(chunk, lines, report, _write_books)
+    return report
+
+def validate_section(row, names):
+    name, description = row.get('name'), row.get('description')
+    if not name or not description:
+        return None, 'Please fill out all fields'
+    if name in names:
+        return None, 'Section already exists'
+    date_created = datetime.now().date()
+    if row.get('date_created'):
+        try:
+            date_created = datetime.strptime(row['date_created'], '%Y-%m-%d').date()
+        except ValueError:
+            return None, 'Invalid date format'
+    return {'name': name, 'description': description, 'date_created': date_created}, None
+
+def _write_sections(chunk):
+    rows = db.session.execute(
+        insert(Section).returning(Section.id, Section.name, Section.description), chunk
+    ).all()
+    search.index_sections(rows)
+    return len(rows)
+
+def import_sections(stream):
+    report = ImportReport()
+    names = set(db.session.execute(select(Section.name)).scalars())
+    chunk, lines = [], []
+    for line, row in read_rows(stream, report):
+        section, error = validate_section(row, names)
+        if error:
+            report.error(line, error)
+            continue
+        names.add(section['name'])
+        chunk.append(section)
+        lines.append(line)
+        if len(chunk) >= CHUNK_SIZE:
+            _flush(chunk, lines, report, _write_sections)
+            chunk, lines = [], []
+    if chunk:
+        _flush(chunk, lines, report, _write_sections)
+    return report
+
+def _csv_lines(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _stream(statement):
+    return db.session.execute(statement.execution_options(yield_per=CHUNK_SIZE))
+
+def export_books():
+    statement = select(Book.id, Book.name, Book.content, Book.author, Book.price, Book.section_id, Section.name,
+                       Book.copies) \
+        .join(Book.section).order_by(Book.id)
+    return _csv_lines(BOOK_COLUMNS, _stream(statement))
+
+def export_sections():
+    statement = select(Section.id, Section.name, Section.description, Section.date_created).order_by(Section.id)
+    return _csv_lines(SECTION_COLUMNS, _stream(statement))
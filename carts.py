@@ -0,0 +1,83 @@
+#carts.py
+from collections import namedtuple
+from flask import current_app, session
+from models import db, Book
+from checkout import checkout_cart
+import replicas
+import versions
+
+# CART_MODE=session keeps the cart in the signed session cookie as
+# {book_id: quantity} instead of the cart table. Adding to the cart is then
+# a cookie update with no database work; /cart checks the lines with one
+# book lookup, and checkout hands them straight to checkout_cart, which
+# reserves the copies. Nothing is written until the order itself.
+#
+# A checkout claims the user's version counter as it was when the cart was
+# last shown, so a double submitted form (both requests carry the same
+# cookie) places one order, not two.
+
+MAX_LINES = 50
+MAX_QUANTITY = 20
+
+CartLine = namedtuple('CartLine', 'id book quantity')
+
+def session_mode():
+    return current_app.config.get('CART_MODE') == 'session'
+
+def _items():
+    return {int(book_id): quantity for book_id, quantity in session.get('cart', {}).items()}
+
+def _save(items):
+    session['cart'] = {str(book_id): quantity for book_id, quantity in items.items()}
+
+def add(book_id, quantity):
+    # returns an error message or None; availability is checked on /cart and at checkout
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        return 'Invalid quantity'
+    items = _items()
+    total = items.get(book_id, 0) + quantity
+    if quantity <= 0 or total > MAX_QUANTITY:
+        return f'Invalid quantity, at most {MAX_QUANTITY} copies per book'
+    if book_id not in items and len(items) >= MAX_LINES:
+        return 'Your cart is full'
+    items[book_id] = total
+    _save(items)
+    return None
+
+def lines(user_id):
+    # one query for every line; books that are gone are dropped from the cart
+    items = _items()
+    books = Book.query.filter(Book.id.in_(items)).all() if items else []
+    found = {book.id: book for book in books}
+    if len(found) < len(items):
+        _save({book_id: quantity for book_id, quantity in items.items() if book_id in found})
+    # checkout claims this value on the primary, so it must not come from
+    # a replica that is behind
+    with replicas.primary():
+        session['cart_version'] = versions.get(versions.user_key(user_id)) if items else None
+    return [CartLine(book_id, found[book_id], quantity) for book_id, quantity in items.items() if book_id in found]
+
+def remove(book_id):
+    items = _items()
+    if items.pop(book_id, None) is None:
+        return False
+    _save(items)
+    return True
+
+def checkout(user_id):
+    items = _items()
+    if not items:
+        return None
+    expected = session.get('cart_version')
+    if expected is None:
+        expected = versions.get(versions.user_key(user_id))
+    transaction_id = checkout_cart(user_id, items=list(items.items()), version=expected)
+    if transaction_id:
+        forget()
+    return transaction_id
+
+def forget():
+    session.pop('cart', None)
+    session.pop('cart_version', None)
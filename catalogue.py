@@ -0,0 +1,71 @@
+#catalogue.py
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager
+from models import db, Section, Book
+import search
+
+PAGE_SIZE = 24
+
+# query layer for the user catalogue: filters run in SQL, books and their
+# sections come back in one batched query and pages are keyset based
+# (section_id, book_id) so deep pages cost the same as the first one
+
+def catalogue_query(sname='', bname='', max_price=None):
+    query = Book.query.join(Book.section).options(contains_eager(Book.section))
+    # a blank search term would be an empty (invalid) MATCH
+    bname = (bname or '').strip()
+    if sname:
+        query = query.filter(Section.name.ilike(f'%{sname}%'))
+    if bname and search.enabled():
+        query = query.filter(Book.id.in_(search.book_ids_matching(bname, 'title')))
+    elif bname:
+        query = query.filter(Book.name.ilike(f'%{bname}%'))
+    if max_price:
+        query = query.filter(Book.price <= max_price)
+    return query
+
+def encode_cursor(book):
+    return f'{book.section_id}-{book.id}'
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        section_id, book_id = cursor.split('-')
+        return int(section_id), int(book_id)
+    except ValueError:
+        return None
+
+def after_cursor(query, cursor):
+    position = decode_cursor(cursor)
+    if not position:
+        return query
+    section_id, book_id = position
+    return query.filter(or_(
+        Book.section_id > section_id,
+        and_(Book.section_id == section_id, Book.id > book_id)
+    ))
+
+class CataloguePage:
+    def __init__(self, books, next_cursor):
+        self.books = books
+        self.next_cursor = next_cursor
+
+    @property
+    def sections(self):
+        # books arrive ordered by section, so grouping keeps the page order
+        grouped = []
+        for book in self.books:
+            if not grouped or grouped[-1][0].id != book.section_id:
+                grouped.append((book.section, []))
+            grouped[-1][1].append(book)
+        return grouped
+
+def catalogue_page(sname='', bname='', max_price=None, after=None, limit=PAGE_SIZE):
+    query = after_cursor(catalogue_query(sname, bname, max_price), after)
+    books = query.order_by(Book.section_id, Book.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor(books[-1])
+    return CataloguePage(books, next_cursor)
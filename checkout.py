@@ -0,0 +1,68 @@
+#checkout.py
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete
+from models import db, Cart, Transaction, Order, Issue, Payment
+from billing import payment_values, transaction_summary
+import inventory
+import versions
+
+ISSUE_DAYS = 7
+
+# converts a user's whole cart into a transaction, its orders and one issue
+# per order in a single database transaction. The statement count does not
+# depend on the cart size:
+#   DELETE cart ... RETURNING  claims the cart; a concurrent checkout of the
+#                              same cart gets no rows back (session carts
+#                              claim the user version instead)
+#   UPDATE book ... RETURNING  reserves the copies and reads the prices,
+#                              raises OutOfStock (and rolls back) if any
+#                              title has too few left
+#   INSERT transaction         with its totals, computed here once
+#   INSERT orders (executemany), INSERT issues (executemany)
+#   INSERT payment
+
+class StaleCart(Exception):
+    pass
+
+def checkout_cart(user_id, items=None, version=None):
+    # items=None checks out the cart table. Session carts (carts.py) pass
+    # their (book_id, quantity) lines and the user version they were shown
+    # at, which is claimed instead of deleting cart rows.
+    try:
+        if items is None:
+            items = db.session.execute(
+                delete(Cart).where(Cart.user_id == user_id).returning(Cart.book_id, Cart.quantity),
+                execution_options={'synchronize_session': False}
+            ).all()
+        elif version is not None and not versions.claim(versions.user_key(user_id), version):
+            raise StaleCart()
+        if not items:
+            db.session.rollback()
+            return None
+
+        prices = inventory.reserve(dict(items))
+        summary = transaction_summary([(prices[book_id], quantity) for book_id, quantity in items])
+        now = datetime.now()
+        transaction_id = db.session.execute(
+            insert(Transaction).returning(Transaction.id), {'user_id': user_id, 'datetime': now, **summary}
+        ).scalar_one()
+
+        lines = [{'transaction_id': transaction_id, 'book_id': book_id, 'quantity': quantity, 'price': prices[book_id]}
+                 for book_id, quantity in items]
+        order_ids = db.session.execute(
+            insert(Order).returning(Order.id), lines
+        ).scalars().all()
+
+        return_date = now + timedelta(days=ISSUE_DAYS)
+        db.session.execute(insert(Issue), [
+            {'user_id': user_id, 'order_id': order_id, 'issue': now.date(), 'return_date': return_date.date(), 'access': True}
+            for order_id in order_ids
+        ])
+        db.session.execute(insert(Payment), payment_values(user_id, transaction_id, summary))
+        if version is None:
+            versions.bump(versions.user_key(user_id))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return transaction_id
@@ -1,11 +1,158 @@
 #config.py
 from dotenv import load_dotenv
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+import sqlite3
 import os
-from main import app
+import replicas
 
 load_dotenv()
 
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
-app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER')
\ No newline at end of file
+def env_bool(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+# configuration profiles, picked with APP_ENV=dev|test|prod (default dev).
+# Every value can still be overridden from the environment / .env file.
+
+class Config:
+    SECRET_KEY = os.getenv('SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
+    SQLALCHEMY_TRACK_MODIFICATIONS = env_bool('SQLALCHEMY_TRACK_MODIFICATIONS')
+    UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER')
+    MAX_UPLOAD_BYTES = env_int('MAX_UPLOAD_BYTES', 100 * 1024 * 1024)
+
+    # book delivery: X-Sendfile (apache, lighttpd) or X-Accel-Redirect (nginx,
+    # set to the internal location that maps onto UPLOAD_FOLDER)
+    USE_X_SENDFILE = env_bool('USE_X_SENDFILE')
+    X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX')
+    BOOK_CACHE_SECONDS = env_int('BOOK_CACHE_SECONDS', 3600)
+
+    # rendered fragment cache (fragments.py): memory, disk or none
+    FRAGMENT_CACHE = os.getenv('FRAGMENT_CACHE', 'memory')
+    FRAGMENT_CACHE_SIZE = env_int('FRAGMENT_CACHE_SIZE', 2048)
+    FRAGMENT_CACHE_DIR = os.getenv('FRAGMENT_CACHE_DIR')
+    FRAGMENT_CACHE_DISK_TTL = env_int('FRAGMENT_CACHE_DISK_TTL', 86400)
+
+    # instrumentation.py: /metrics (Prometheus text, optional bearer token),
+    # Server-Timing headers and the slow-query log. The slow-query log is
+    # only served with a token; METRICS_REQUIRE_TOKEN leaves /metrics out
+    # altogether when no token is set.
+    METRICS_ENABLED = env_bool('METRICS_ENABLED', True)
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    METRICS_REQUIRE_TOKEN = env_bool('METRICS_REQUIRE_TOKEN')
+    SERVER_TIMING = env_bool('SERVER_TIMING', True)
+    SLOW_QUERY_MS = env_int('SLOW_QUERY_MS', 100)
+
+    # ratelimit.py: memory (per process) or sqlite (shared by the workers
+    # on one host); limits are "<requests>/<seconds>", empty to turn one off
+    RATELIMIT_ENABLED = env_bool('RATELIMIT_ENABLED', True)
+    RATELIMIT_STORAGE = os.getenv('RATELIMIT_STORAGE', 'memory')
+    RATELIMIT_STORAGE_PATH = os.getenv('RATELIMIT_STORAGE_PATH')
+    RATELIMIT_LOGIN_IP = os.getenv('RATELIMIT_LOGIN_IP', '30/60')
+    RATELIMIT_LOGIN_USER = os.getenv('RATELIMIT_LOGIN_USER', '10/300')
+    RATELIMIT_CART = os.getenv('RATELIMIT_CART', '60/60')
+    RATELIMIT_CHECKOUT = os.getenv('RATELIMIT_CHECKOUT', '10/60')
+
+    # carts: table (a cart row per line) or session (signed cookie, written
+    # at checkout only, see carts.py)
+    CART_MODE = os.getenv('CART_MODE', 'table')
+
+    # background jobs (jobs.py)
+    SCHEDULER_ENABLED = env_bool('SCHEDULER_ENABLED')
+    JOBS_INTERVAL_SECONDS = env_int('JOBS_INTERVAL_SECONDS', 300)
+    REMINDER_DAYS = env_int('REMINDER_DAYS', 1)
+    CART_MAX_AGE_DAYS = env_int('CART_MAX_AGE_DAYS', 7)
+    # transactions older than this move to the archive tables, 0 keeps everything hot
+    ARCHIVE_AFTER_DAYS = env_int('ARCHIVE_AFTER_DAYS', 365)
+
+    # server databases (postgres, mysql)
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 10)
+    DB_POOL_TIMEOUT = env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+    DB_POOL_PRE_PING = env_bool('DB_POOL_PRE_PING', True)
+    DB_STATEMENT_TIMEOUT_MS = env_int('DB_STATEMENT_TIMEOUT_MS', 0)
+
+    # read replicas for @read_only views (replicas.py), comma separated
+    # URIs; reads stay on the primary this long after a user's own write
+    DB_REPLICA_URIS = os.getenv('DB_REPLICA_URIS', '')
+    REPLICA_STICKY_SECONDS = env_int('REPLICA_STICKY_SECONDS', 10)
+
+    # sqlite, applied on every new connection
+    SQLITE_WAL = env_bool('SQLITE_WAL', True)
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    SQLITE_MMAP_SIZE = env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+
+class DevelopmentConfig(Config):
+    QUERY_BUDGET_STRICT = env_bool('QUERY_BUDGET_STRICT')
+    BOOTSTRAP_ON_START = env_bool('BOOTSTRAP_ON_START', True)
+
+class TestingConfig(Config):
+    TESTING = True
+    QUERY_BUDGET_STRICT = True
+    SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URI', 'sqlite://')
+    SQLITE_WAL = False
+    RATELIMIT_ENABLED = env_bool('RATELIMIT_ENABLED')
+
+class ProductionConfig(Config):
+    DEBUG = False
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 20)
+    DB_STATEMENT_TIMEOUT_MS = env_int('DB_STATEMENT_TIMEOUT_MS', 30000)
+    METRICS_REQUIRE_TOKEN = env_bool('METRICS_REQUIRE_TOKEN', True)
+
+profiles = {
+    'dev': DevelopmentConfig,
+    'test': TestingConfig,
+    'prod': ProductionConfig,
+}
+
+def engine_options(config, uri=None):
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        # no server pool to size, the pragmas are set on connect below
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    elif timeout and url.get_backend_name() == 'mysql':
+        options['connect_args'] = {'init_command': f'SET SESSION max_execution_time={timeout}'}
+    return options
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    config = current_app.config if has_app_context() else vars(Config)
+    cursor = dbapi_connection.cursor()
+    if config['SQLITE_WAL']:
+        # WAL lets readers run while a writer holds the lock
+        cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
+
+def init_app(app, profile=None):
+    app.config.from_object(profiles[profile or os.getenv('APP_ENV', 'dev')])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    app.config['SQLALCHEMY_BINDS'] = {f'replica{index}': {'url': uri, **engine_options(app.config, uri)}
+                                      for index, uri in enumerate(replicas.replica_uris(app.config))}
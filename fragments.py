@@ -0,0 +1,117 @@
+#fragments.py
+import os
+import random
+import tempfile
+import time
+from hashlib import sha1
+from flask import g, render_template
+from markupsafe import Markup
+from cache import TTLCache
+import versions
+
+# cache for rendered template fragments that look the same for every user
+# (book cards, section tables). Keys carry the catalogue version, so any
+# book/section write makes every old fragment unreachable at once; they
+# age out of the LRU memory cache, or out of the optional disk cache that
+# lets the workers of one host share renders.
+#
+#   {{ cached_fragment('user/_books.html', fragment_key(section.id, books=books), books=books) }}
+
+class DiskBackend:
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(key.encode()).hexdigest() + '.html')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, self._path(key))
+        if random.random() < 0.01:
+            self.prune()
+
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+
+class FragmentCache:
+    def __init__(self):
+        self.enabled = False
+        self.memory = None
+        self.disk = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        backend = app.config.get('FRAGMENT_CACHE', 'memory')
+        self.enabled = backend != 'none'
+        self.memory = TTLCache(maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 2048), ttl=0)
+        if backend == 'disk':
+            directory = app.config.get('FRAGMENT_CACHE_DIR') or os.path.join(app.instance_path, 'fragments')
+            self.disk = DiskBackend(directory, app.config.get('FRAGMENT_CACHE_DISK_TTL', 86400))
+        app.jinja_env.globals['cached_fragment'] = self.render
+        app.jinja_env.globals['fragment_key'] = ids_key
+        app.jinja_env.globals['stock_key'] = stock_key
+
+    def catalogue_version(self):
+        if 'catalogue_version' not in g:
+            g.catalogue_version = versions.get(versions.CATALOGUE)
+        return g.catalogue_version
+
+    def render(self, template, key, **context):
+        if not self.enabled:
+            return Markup(render_template(template, **context))
+        full_key = f'{template}:{self.catalogue_version()}:{key}'
+        html = self.memory.get(full_key)
+        if html is None and self.disk:
+            html = self.disk.get(full_key)
+            if html is not None:
+                self.memory.set(full_key, html)
+        if html is None:
+            self.misses += 1
+            html = render_template(template, **context)
+            self.memory.set(full_key, html)
+            if self.disk:
+                self.disk.set(full_key, html)
+        else:
+            self.hits += 1
+        return Markup(html)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk:
+            self.disk.clear()
+
+def ids_key(*parts, books=()):
+    # filtered or paged views show a subset of a section, key on the exact books
+    ids = ','.join(str(book.id) for book in books)
+    return ':'.join(map(str, parts)) + ':' + sha1(ids.encode()).hexdigest()[:16]
+
+def stock_key(*parts, books=()):
+    # the catalogue version does not move on every checkout, so fragments
+    # showing exact available counts key on them as well
+    stock = ','.join(f'{book.id}={book.available}' for book in books)
+    return ':'.join(map(str, parts)) + ':' + sha1(stock.encode()).hexdigest()[:16]
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,54 @@
+#gunicorn.conf.py
+import multiprocessing
+import os
+
+# production server settings, picked up by `gunicorn wsgi:app` from the
+# working directory. Everything can be overridden from the environment.
+#
+# GUNICORN_WORKER_CLASS
+#   gthread (default)  WEB_CONCURRENCY processes x GUNICORN_THREADS threads.
+#                      Size DB_POOL_SIZE + DB_MAX_OVERFLOW to at least the
+#                      thread count.
+#   gevent             one greenlet per connection, up to
+#                      GUNICORN_WORKER_CONNECTIONS per process, for many slow
+#                      or idle readers (pip install -r requirement-gevent.txt).
+#                      Waiting requests cost a greenlet, not a thread; the
+#                      pool size caps how many of them hit the database at
+#                      once. With SQLite a query still blocks its whole
+#                      worker while it runs.
+#   sync               one request per process at a time.
+#
+# The scoped session from Flask-SQLAlchemy belongs to the app context, which
+# is per thread / per greenlet, so views need no changes for either model.
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gevent':
+    # patch before the app and its drivers are imported by preload_app
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# recycle workers now and then so slow leaks cannot build up
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 500))
+# build the app once in the master, workers share its memory copy-on-write
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes', 'on')
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+
+def post_fork(server, worker):
+    # connections opened by the master (bootstrap, migrations) must not be
+    # shared with the forked workers; drop them from the pool without
+    # closing the master's sockets
+    if not preload_app:
+        return
+    from models import db
+    app = worker.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,56 @@
+#identity.py
+from flask_login import LoginManager, UserMixin
+from sqlalchemy import event
+from models import db, User
+from cache import TTLCache
+
+# the logged in user, loaded once per request by flask_login (kept on
+# flask.g) and backed by a TTL cache keyed by user id, so protected views
+# do not need a round trip just to check who is asking.
+
+IDENTITY_TTL = 60
+
+login_manager = LoginManager()
+login_manager.login_view = 'routes.login'
+login_manager.login_message = 'Please login to continue'
+
+_cache = TTLCache(maxsize=10000, ttl=IDENTITY_TTL)
+
+class Identity(UserMixin):
+    def __init__(self, id, username, name, is_admin):
+        self.id = id
+        self.username = username
+        self.name = name
+        self.is_admin = is_admin
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.name, user.is_admin)
+
+@login_manager.user_loader
+def load_identity(user_id):
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    identity = _cache.get(user_id)
+    if identity is None:
+        row = db.session.query(User.id, User.username, User.name, User.is_admin).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        identity = Identity(*row)
+        _cache.set(user_id, identity)
+    return identity
+
+def remember(user):
+    identity = Identity.from_user(user)
+    _cache.set(user.id, identity)
+    return identity
+
+def invalidate(user_id):
+    _cache.delete(user_id)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, user):
+    invalidate(user.id)
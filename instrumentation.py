@@ -0,0 +1,218 @@
+#instrumentation.py
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from flask import g, has_app_context, has_request_context, current_app, request, Response, abort
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from functools import wraps
+
+# counts the SQL statements issued while handling the current request/app
+# context, so views can declare how many round trips they are allowed.
+# init_app adds the rest: per-route latency, SQL and template time per
+# request, a slow-query log, Server-Timing headers and a Prometheus
+# text endpoint at /metrics. Metrics are kept per process.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SLOW_LOG_SIZE = 100
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                # one counter per bucket, then sum and count
+                counts = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: list(counts) for labels, counts in self.series.items()}
+        for labels, counts in sorted(series.items()):
+            pairs = [f'{key}="{_escape(value)}"' for key, value in zip(self.labels, labels)]
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-2] + counts[-1:]):
+                bucket_labels = ','.join(pairs + [f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {count}')
+            label_text = '{' + ','.join(pairs) + '}' if pairs else ''
+            lines.append(f'{self.name}_sum{label_text} {counts[-2]}')
+            lines.append(f'{self.name}_count{label_text} {counts[-1]}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(self.labels, labels))
+            lines.append(f'{self.name}{{{pairs}}} {value}' if pairs else f'{self.name} {value}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_latency = Histogram('http_request_duration_seconds', 'Time spent handling a request.',
+                            ('endpoint', 'method', 'status'), LATENCY_BUCKETS)
+request_statements = Histogram('http_request_sql_statements', 'SQL statements issued per request.',
+                               ('endpoint',), STATEMENT_BUCKETS)
+sql_latency = Histogram('sql_statement_duration_seconds', 'Time spent executing SQL statements.',
+                        ('endpoint',), LATENCY_BUCKETS)
+template_latency = Histogram('template_render_duration_seconds', 'Time spent rendering templates.',
+                             ('template',), LATENCY_BUCKETS)
+slow_queries = Counter('sql_slow_queries_total', 'SQL statements slower than SLOW_QUERY_MS.', ('endpoint',))
+METRICS = (request_latency, request_statements, sql_latency, template_latency, slow_queries)
+
+# most recent slow statements, newest last; parameters are left out on purpose
+slow_log = deque(maxlen=SLOW_LOG_SIZE)
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'none'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_statement(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if not has_app_context():
+        return
+    g.sql_time = g.get('sql_time', 0.0) + elapsed
+    endpoint = _endpoint()
+    sql_latency.observe(elapsed, endpoint)
+    threshold = current_app.config.get('SLOW_QUERY_MS')
+    if threshold and elapsed * 1000 >= threshold:
+        slow_queries.inc(endpoint)
+        entry = {'endpoint': endpoint, 'ms': round(elapsed * 1000, 2), 'statement': statement[:1000],
+                 'executemany': executemany, 'at': datetime.now().isoformat(timespec='seconds')}
+        slow_log.append(entry)
+        current_app.logger.warning('Slow query (%.1f ms) in %s: %s', entry['ms'], endpoint, entry['statement'])
+
+@event.listens_for(Engine, 'handle_error')
+def drop_failed_statement(context):
+    starts = context.connection.info.get('query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+def statement_count():
+    return g.get('sql_statements', 0)
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+# decorator for query_budget, put it under the route/auth decorators so only
+# the view itself (including its template) is counted.
+# Over budget is an error under app.testing or QUERY_BUDGET_STRICT, a warning otherwise.
+def query_budget(limit):
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            start = statement_count()
+            response = func(*args, **kwargs)
+            used = statement_count() - start
+            if used > limit:
+                message = f'{func.__name__} issued {used} SQL statements, budget is {limit}'
+                if current_app.testing or current_app.config.get('QUERY_BUDGET_STRICT'):
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+            return response
+        inner.query_budget = limit
+        return inner
+    return decorator
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+def _template_finished(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    template_latency.observe(elapsed, template.name or 'string')
+    # fragments render inside their page, only count the outermost render
+    if not starts:
+        g.template_time = g.get('template_time', 0.0) + elapsed
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+def _record_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = _endpoint()
+    if endpoint == 'metrics':
+        return response
+    request_latency.observe(elapsed, endpoint, request.method, str(response.status_code))
+    request_statements.observe(statement_count(), endpoint)
+    if current_app.config.get('SERVER_TIMING'):
+        timings = [
+            f'db;dur={g.get("sql_time", 0.0) * 1000:.1f};desc="{statement_count()} queries"',
+            f'tpl;dur={g.get("template_time", 0.0) * 1000:.1f}',
+            f'app;dur={elapsed * 1000:.1f}',
+        ]
+        response.headers.add('Server-Timing', ', '.join(timings))
+    return response
+
+def exposition():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+def metrics():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    if request.args.get('slow'):
+        # statement text says too much to be public
+        if not token:
+            abort(404)
+        return {'threshold_ms': current_app.config.get('SLOW_QUERY_MS'), 'queries': list(slow_log)}
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    if app.config.get('METRICS_REQUIRE_TOKEN') and not app.config.get('METRICS_TOKEN'):
+        app.logger.warning('METRICS_TOKEN is not set, /metrics is disabled')
+        return
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,50 @@
+#inventory.py
+from sqlalchemy import update, case
+from models import db, Book
+import versions
+
+# stock per title. book.available is copies minus the copies on active
+# issues, and it only ever moves through the conditional UPDATEs below, so
+# concurrent checkouts cannot over-issue a title: the database takes a row
+# lock per book, re-checks `available >= quantity` and either reserves or
+# leaves the row alone. No table lock and no read-modify-write in Python.
+#
+# Book cards show in stock / out of stock, so the catalogue version (and
+# with it the cached cards) only moves when a title runs out or comes back.
+
+class OutOfStock(Exception):
+    def __init__(self, book_ids):
+        super().__init__(f'Not enough copies available of books {sorted(book_ids)}')
+        self.book_ids = book_ids
+
+def _by_book(quantities):
+    return case(quantities, value=Book.id)
+
+def reserve(quantities):
+    # quantities is {book_id: copies}; returns {book_id: price} or raises
+    # OutOfStock, the caller rolls back
+    wanted = _by_book(quantities)
+    rows = db.session.execute(
+        update(Book).where(Book.id.in_(quantities), Book.available >= wanted)
+        .values(available=Book.available - wanted)
+        .returning(Book.id, Book.price, Book.available),
+        execution_options={'synchronize_session': False}
+    ).all()
+    if len(rows) < len(quantities):
+        raise OutOfStock(set(quantities) - {id for id, price, available in rows})
+    if any(available == 0 for id, price, available in rows):
+        versions.bump(versions.CATALOGUE)
+    return {id: price for id, price, available in rows}
+
+def release(quantities):
+    # copies coming back from expired or returned issues
+    if not quantities:
+        return
+    rows = db.session.execute(
+        update(Book).where(Book.id.in_(quantities))
+        .values(available=Book.available + _by_book(quantities))
+        .returning(Book.id, Book.available),
+        execution_options={'synchronize_session': False}
+    ).all()
+    if any(available == quantities[id] for id, available in rows):
+        versions.bump(versions.CATALOGUE)
@@ -0,0 +1,147 @@
+#jobs.py
+import threading
+import time
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update, delete, select
+from models import db, User, Book, Issue, Order, Cart
+import archive
+import inventory
+import versions
+
+# periodic maintenance. Every job is one set-based statement (or a batched
+# scan), so a run costs the same whether there are a hundred issue rows or
+# millions, and running a job twice is harmless.
+# Run them in a separate process with `flask run-jobs`, or in-process with
+# SCHEDULER_ENABLED (only sensible with a single app process).
+
+REMINDER_BATCH = 500
+EXPIRE_BATCH = 1000
+
+def expire_issues(today=None):
+    # ends overdue issues a batch at a time and puts their copies back
+    today = today or date.today()
+    statement = select(Issue.id, Order.book_id, Order.quantity).join(Issue.orders) \
+        .where(Issue.access == True, Issue.return_date < today).limit(EXPIRE_BATCH)
+    expired = 0
+    while True:
+        rows = db.session.execute(statement).all()
+        if not rows:
+            break
+        # only the issues this run switched off, another process may be expiring too
+        ended = set(db.session.execute(
+            update(Issue).where(Issue.id.in_([row[0] for row in rows]), Issue.access == True)
+            .values(access=False).returning(Issue.id),
+            execution_options={'synchronize_session': False}
+        ).scalars())
+        copies = {}
+        for id, book_id, quantity in rows:
+            if id in ended:
+                copies[book_id] = copies.get(book_id, 0) + quantity
+        inventory.release(copies)
+        if ended:
+            versions.bump(versions.ISSUES)
+        db.session.commit()
+        expired += len(ended)
+    return expired
+
+def notify_due(user, issues):
+    # no mail server is configured for the library, so reminders go to the
+    # log; replace this to send them somewhere else
+    titles = ', '.join(f'{name} ({return_date})' for name, return_date in issues)
+    current_app.logger.info('Reminder for %s: due back soon: %s', user, titles)
+
+def send_due_reminders(days=None, today=None):
+    days = current_app.config.get('REMINDER_DAYS', 1) if days is None else days
+    today = today or date.today()
+    due = today + timedelta(days=days)
+    statement = select(Issue.id, Issue.user_id, User.username, Book.name, Issue.return_date) \
+        .join(User, Issue.user_id == User.id).join(Issue.orders).join(Order.book) \
+        .where(Issue.access == True, Issue.reminded == False, Issue.return_date <= due, Issue.return_date >= today) \
+        .order_by(Issue.user_id)
+
+    sent = 0
+    while True:
+        rows = db.session.execute(statement.limit(REMINDER_BATCH)).all()
+        if not rows:
+            break
+        by_user = {}
+        for id, user_id, username, name, return_date in rows:
+            by_user.setdefault(username, []).append((name, return_date))
+        for username, issues in by_user.items():
+            notify_due(username, issues)
+        db.session.execute(
+            update(Issue).where(Issue.id.in_([row[0] for row in rows])).values(reminded=True),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        sent += len(rows)
+    return sent
+
+def cleanup_abandoned_carts(max_age_days=None, now=None):
+    max_age_days = current_app.config.get('CART_MAX_AGE_DAYS', 7) if max_age_days is None else max_age_days
+    cutoff = (now or datetime.now()) - timedelta(days=max_age_days)
+    result = db.session.execute(
+        delete(Cart).where(Cart.updated < cutoff),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    return result.rowcount
+
+JOBS = {
+    'expire_issues': expire_issues,
+    'send_due_reminders': send_due_reminders,
+    'cleanup_abandoned_carts': cleanup_abandoned_carts,
+    'archive_old_transactions': archive.archive_old_transactions,
+}
+
+def run_all(app):
+    results = {}
+    for name, job in JOBS.items():
+        with app.app_context():
+            try:
+                results[name] = job()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Job %s failed', name)
+                results[name] = None
+    return results
+
+class Scheduler:
+    # runs every job every `interval` seconds on a daemon thread
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='jobs', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            results = run_all(self.app)
+            self.app.logger.info('Jobs ran: %s', results)
+
+def init_app(app):
+    app.cli.add_command(run_jobs_command)
+    if app.config.get('SCHEDULER_ENABLED'):
+        app.extensions['scheduler'] = Scheduler(app, app.config['JOBS_INTERVAL_SECONDS']).start()
+
+@click.command('run-jobs')
+@click.option('--once', is_flag=True, help='Run every job once and exit.')
+@with_appcontext
+def run_jobs_command(once):
+    """Run the background jobs (issue expiry, reminders, cart cleanup)."""
+    app = current_app._get_current_object()
+    while True:
+        print(run_all(app))
+        if once:
+            break
+        time.sleep(app.config['JOBS_INTERVAL_SECONDS'])
@@ -1,15 +1,50 @@
 #main.py
-from flask import Flask, render_template
+from flask import Flask
 
-app = Flask(__name__)
+# application factory. Importing this module is cheap: blueprints, models
+# and routes are only imported when an app is built, and nothing touches
+# the database until a request (or `flask bootstrap`) needs it.
+# FLASK_APP=main.py picks create_app up automatically; servers load wsgi:app.
 
-import config
+def create_app(profile=None):
+    app = Flask(__name__)
 
-import models
+    import config
+    config.init_app(app, profile)
 
-import api
+    from models import db
+    db.init_app(app)
 
-import routes
+    import storage
+    storage.init_app(app)
+
+    import replicas
+    replicas.init_app(app)
+
+    from identity import login_manager
+    login_manager.init_app(app)
+
+    import instrumentation
+    instrumentation.init_app(app)
+
+    from ratelimit import limiter
+    limiter.init_app(app)
+
+    from fragments import fragment_cache
+    fragment_cache.init_app(app)
+
+    import routes
+    import api
+    app.register_blueprint(routes.bp)
+    app.register_blueprint(api.bp)
+
+    import bootstrap
+    bootstrap.init_app(app)
+
+    import jobs
+    jobs.init_app(app)
+
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,167 @@
+#migrations.py
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text, select, update, bindparam, table, column, MetaData, Table, Column, Index, DateTime
+from models import db
+
+# versioned schema changes for existing databases. db.create_all() only
+# creates missing tables, so anything that alters a table that is already
+# there belongs here. The applied version is kept in schema_version, each
+# migration runs in its own transaction and is also safe on a database
+# that create_all() has just built. A migration names the columns and
+# indexes it touches itself, and copies any rule it applies, instead of
+# reading them off the models or the app, which describe the latest
+# schema and rules, not the ones the migration was written against.
+
+migrations = []
+BACKFILL_BATCH = 1000
+
+def migration(version, description):
+    def decorator(func):
+        migrations.append((version, description, func))
+        return func
+    return decorator
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+def add_column(conn, table, name, definition):
+    if name not in {column['name'] for column in inspect(conn).get_columns(table)}:
+        conn.execute(text(f'ALTER TABLE {_quote(conn, table)} ADD COLUMN {_quote(conn, name)} {definition}'))
+
+def create_index(conn, name, table, *columns, unique=False):
+    target = Table(table, MetaData(), *(Column(column) for column in columns))
+    Index(name, *target.c, unique=unique).create(conn, checkfirst=True)
+
+@migration(1, 'payment totals, one payment per transaction')
+def payment_totals(conn):
+    add_column(conn, 'payment', 'total', 'FLOAT')
+    add_column(conn, 'payment', 'gst', 'FLOAT')
+    # GET /payments used to insert a row per page view, keep the first one
+    conn.execute(text(
+        'DELETE FROM payment WHERE id NOT IN '
+        '(SELECT id FROM (SELECT min(id) AS id FROM payment GROUP BY transaction_id) AS keep)'
+    ))
+    create_index(conn, 'uq_payment_transaction', 'payment', 'transaction_id', unique=True)
+    create_index(conn, 'ix_payment_user_id', 'payment', 'user_id')
+
+@migration(2, 'indexes on hot lookup columns, unique cart lines')
+def lookup_indexes(conn):
+    # merge duplicate cart lines into the oldest one before the unique index
+    conn.execute(text(
+        'UPDATE cart SET quantity = (SELECT sum(quantity) FROM cart AS dup '
+        'WHERE dup.user_id = cart.user_id AND dup.book_id = cart.book_id) '
+        'WHERE id IN (SELECT id FROM (SELECT min(id) AS id FROM cart GROUP BY user_id, book_id '
+        'HAVING count(*) > 1) AS first)'
+    ))
+    conn.execute(text(
+        'DELETE FROM cart WHERE id NOT IN '
+        '(SELECT id FROM (SELECT min(id) AS id FROM cart GROUP BY user_id, book_id) AS keep)'
+    ))
+    create_index(conn, 'ix_book_section_id', 'book', 'section_id')
+    create_index(conn, 'ix_issue_user_id', 'issue', 'user_id')
+    create_index(conn, 'ix_issue_order_id', 'issue', 'order_id')
+    create_index(conn, 'uq_cart_user_book', 'cart', 'user_id', 'book_id', unique=True)
+    create_index(conn, 'ix_cart_book_id', 'cart', 'book_id')
+    create_index(conn, 'uq_payment_transaction', 'payment', 'transaction_id', unique=True)
+    create_index(conn, 'ix_payment_user_id', 'payment', 'user_id')
+    create_index(conn, 'ix_transaction_user_datetime', 'transaction', 'user_id', 'datetime')
+    create_index(conn, 'ix_order_transaction_id', 'order', 'transaction_id')
+    create_index(conn, 'ix_order_book_id', 'order', 'book_id')
+
+@migration(3, 'book files')
+def book_files(conn):
+    # the upload table itself is new and comes from create_all()
+    add_column(conn, 'book', 'upload_id', 'INTEGER REFERENCES upload (id)')
+    create_index(conn, 'ix_book_upload_id', 'book', 'upload_id')
+
+@migration(4, 'issue expiry and reminders, cart age')
+def background_jobs(conn):
+    add_column(conn, 'issue', 'reminded', 'BOOLEAN NOT NULL DEFAULT FALSE')
+    add_column(conn, 'cart', 'updated', DateTime().compile(dialect=conn.dialect))
+    # existing carts get a full grace period from today
+    conn.execute(text('UPDATE cart SET updated = CURRENT_TIMESTAMP WHERE updated IS NULL'))
+    create_index(conn, 'ix_issue_access_return_date', 'issue', 'access', 'return_date')
+
+def _totals_v5(lines):
+    # billing.transaction_summary as it was when migration 5 was written
+    subtotal = sum(price * quantity for price, quantity in lines)
+    gst = round(subtotal * 0.18, 2)
+    return {'subtotal': subtotal, 'gst': gst, 'amount_payable': round(subtotal + gst, 2),
+            'item_count': sum(quantity for price, quantity in lines)}
+
+@migration(5, 'transaction totals')
+def transaction_totals(conn):
+    add_column(conn, 'transaction', 'subtotal', 'FLOAT')
+    add_column(conn, 'transaction', 'gst', 'FLOAT')
+    add_column(conn, 'transaction', 'amount_payable', 'FLOAT')
+    add_column(conn, 'transaction', 'item_count', 'INTEGER')
+    transaction = table('transaction', column('id'), column('subtotal'), column('gst'),
+                        column('amount_payable'), column('item_count'))
+    order = table('order', column('transaction_id'), column('price'), column('quantity'))
+    # backfill from the stored order prices, a batch of transactions at a time
+    statement = select(transaction.c.id, order.c.price, order.c.quantity) \
+        .outerjoin(order, order.c.transaction_id == transaction.c.id).order_by(transaction.c.id)
+    fill = update(transaction).where(transaction.c.id == bindparam('transaction_id'))
+    while True:
+        ids = conn.execute(select(transaction.c.id).where(transaction.c.subtotal.is_(None))
+                           .order_by(transaction.c.id).limit(BACKFILL_BATCH)).scalars().all()
+        if not ids:
+            break
+        lines = {id: [] for id in ids}
+        for id, price, quantity in conn.execute(statement.where(transaction.c.id.in_(ids))):
+            if price is not None:
+                lines[id].append((price, quantity))
+        conn.execute(fill, [{'transaction_id': id, **_totals_v5(rows)} for id, rows in lines.items()])
+
+@migration(6, 'book copies and availability')
+def book_stock(conn):
+    add_column(conn, 'book', 'copies', 'INTEGER NOT NULL DEFAULT 5')
+    add_column(conn, 'book', 'available', 'INTEGER NOT NULL DEFAULT 5')
+    # copies on active issues are out; a title issued more often than it
+    # has copies gets its copy count raised to match
+    conn.execute(text(
+        f'UPDATE book SET available = copies - (SELECT coalesce(sum(o.quantity), 0) '
+        f'FROM {_quote(conn, "order")} AS o JOIN issue AS i ON i.order_id = o.id '
+        f'WHERE o.book_id = book.id AND i.access = :active)'
+    ), {'active': True})
+    conn.execute(text('UPDATE book SET copies = copies - available, available = 0 WHERE available < 0'))
+
+def current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+
+def latest_version():
+    return max(version for version, description, func in migrations)
+
+def upgrade():
+    with db.engine.begin() as conn:
+        version = current_version(conn)
+    applied = []
+    for number, description, func in sorted(migrations, key=lambda item: item[0]):
+        if number <= version:
+            continue
+        with db.engine.begin() as conn:
+            func(conn)
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': number})
+        current_app.logger.info('Applied migration %s: %s', number, description)
+        applied.append(number)
+    return applied
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    applied = upgrade()
+    if applied:
+        print(f'Applied migrations {", ".join(map(str, applied))}')
+    else:
+        print(f'Database is up to date (version {latest_version()})')
+
+@click.command('db-version')
+@with_appcontext
+def db_version_command():
+    """Show the schema version of the database."""
+    with db.engine.begin() as conn:
+        print(f'Database version {current_version(conn)}, latest {latest_version()}')
@@ -1,9 +1,9 @@
 #models.py
-from main import app
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash
+from datetime import datetime
+from replicas import RoutingSession
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -13,10 +13,17 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
     payment = db.relationship('Payment', backref='user', lazy=True, cascade='all, delete-orphan')
     issue_date = db.relationship('Issue', backref='user', lazy=True, cascade='all, delete-orphan')
-#class Upload(db.Model):
-#    id = db.Column(db.Integer, primary_key=True)
-#   name = db.Column(db.String(32), unique=True)
-    
+
+class Upload(db.Model):
+    # a stored book file, content addressed: one row and one file per sha256
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    path = db.Column(db.String(256), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(256), nullable=True)
+    datetime = db.Column(db.DateTime, nullable=False)
+    books = db.relationship('Book', backref='upload', lazy=True)
+
 
 class Section(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -25,62 +32,115 @@ class Section(db.Model):
     description = db.Column(db.String(2048), nullable=False)
     books = db.relationship('Book', backref='section', lazy=True, cascade='all, delete-orphan')
 
+DEFAULT_COPIES = 5
+
+def _all_copies_available(context):
+    return context.get_current_parameters().get('copies', DEFAULT_COPIES)
+
 class Book(db.Model):
+    __table_args__ = (db.CheckConstraint('available >= 0', name='ck_book_available'),)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     content = db.Column(db.String(2048), nullable=False)
     author = db.Column(db.String(64), nullable=False)
     price = db.Column(db.Float, nullable=False)
-    section_id = db.Column(db.Integer, db.ForeignKey('section.id'), nullable=False)
-    #upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'))
-    #uploads = db.relationship('Upload', backref='book', lazy=True, cascade='all, delete-orphan')
+    section_id = db.Column(db.Integer, db.ForeignKey('section.id'), nullable=False, index=True)
+    upload_id = db.Column(db.Integer, db.ForeignKey('upload.id'), nullable=True, index=True)
+    # copies the library owns, and copies not on an active issue (inventory.py)
+    copies = db.Column(db.Integer, nullable=False, default=DEFAULT_COPIES, server_default=str(DEFAULT_COPIES))
+    available = db.Column(db.Integer, nullable=False, default=_all_copies_available, server_default=str(DEFAULT_COPIES))
     carts = db.relationship('Cart', backref='book', lazy=True, cascade='all, delete-orphan')
     orders = db.relationship('Order', backref='book', lazy=True, cascade='all, delete-orphan')
+
+    @property
+    def downloadable(self):
+        return self.upload_id is not None
     
 class Issue(db.Model):
+    # the expiry job looks for issues that still have access past return_date
+    __table_args__ = (db.Index('ix_issue_access_return_date', 'access', 'return_date'),)
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
     issue = db.Column(db.Date, nullable=False)
     return_date = db.Column(db.Date, nullable=False)
     access = db.Column(db.Boolean, default=False)
+    reminded = db.Column(db.Boolean, nullable=False, default=False)
     
 class Cart(db.Model):
+    # the unique (user_id, book_id) index also serves lookups by user_id
+    __table_args__ = (db.Index('uq_cart_user_book', 'user_id', 'book_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.DateTime, nullable=True, default=datetime.now)
     
 
 class Payment(db.Model):
+    # one payment per transaction
+    __table_args__ = (db.Index('uq_payment_transaction', 'transaction_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id'), nullable=False)
-    amount_payable = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Float, nullable=True)
+    gst = db.Column(db.Float, nullable=True)
+    amount_payable = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), nullable=False)
     datetime = db.Column(db.DateTime, nullable=False)
 
 class Transaction(db.Model):
+    # order history is always filtered by user and sorted by datetime
+    __table_args__ = (db.Index('ix_transaction_user_datetime', 'user_id', 'datetime'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     datetime = db.Column(db.DateTime, nullable=False)
-    payment = db.relationship('Payment', backref='transaction', lazy=True, cascade='all, delete-orphan')
+    # totals of the orders as charged, written once at checkout
+    subtotal = db.Column(db.Float, nullable=True)
+    gst = db.Column(db.Float, nullable=True)
+    amount_payable = db.Column(db.Float, nullable=True)
+    item_count = db.Column(db.Integer, nullable=True)
+    payment = db.relationship('Payment', backref='transaction', lazy=True, uselist=False, cascade='all, delete-orphan')
     orders = db.relationship('Order', backref='transaction', lazy=True, cascade='all, delete-orphan')
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id'), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     issue_date = db.relationship('Issue', backref='orders', lazy=True, cascade='all, delete-orphan')
 
-with app.app_context():
-    db.create_all()
-    # if admin exists, else create admin
-    admin = User.query.filter_by(is_admin=True).first()
-    if not admin:
-        password_hash = generate_password_hash('admin')
-        admin = User(username='librarian', passhash=password_hash, name='Librarian', is_admin=True)
-        db.session.add(admin)
-        db.session.commit()
+
+class Version(db.Model):
+    # named change counters (catalogue, per-user history) shared by every
+    # worker, used to validate ETags and cached fragments
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class ArchivedTransaction(db.Model):
+    # old transactions moved out of the hot tables by archive.py, appended
+    # and never updated. The summary stays in columns for listing, the
+    # orders, payment and issues are zlib compressed JSON in data.
+    __tablename__ = 'archive_transaction'
+    __table_args__ = (db.Index('ix_archive_transaction_user_id', 'user_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    datetime = db.Column(db.DateTime, nullable=False)
+    # YYYY-MM of the transaction, the unit old data is handled in
+    period = db.Column(db.String(7), nullable=False, index=True)
+    subtotal = db.Column(db.Float, nullable=True)
+    gst = db.Column(db.Float, nullable=True)
+    amount_payable = db.Column(db.Float, nullable=True)
+    item_count = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    archived = db.Column(db.DateTime, nullable=False)
+
+class ArchivedBookTotal(db.Model):
+    # running totals of archived orders per book, so analytics still
+    # counts them
+    __tablename__ = 'archive_book_total'
+    book_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    copies = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
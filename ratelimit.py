@@ -0,0 +1,158 @@
+#ratelimit.py
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import current_app, request, session
+
+# request throttling with sliding window counters: a hit is allowed while
+#   previous_window_count * (share of the previous window still in view) + current_window_count
+# stays under the limit. Two integers per key, no per-request timestamps.
+# Checks run before the view, so a rejected login never reaches the
+# database or check_password_hash.
+#
+#   memory  per process (default)
+#   sqlite  one small database file shared by all workers on the host
+#
+# Limits are config strings "<count>/<seconds>", e.g. RATELIMIT_LOGIN_IP = '20/60'.
+
+MAX_MEMORY_KEYS = 100000
+
+def parse_limit(value):
+    count, seconds = str(value).split('/')
+    return int(count), int(seconds)
+
+def _estimate(previous, current, period, now):
+    elapsed = (now % period) / period
+    return previous * (1 - elapsed) + current
+
+def _retry_after(period, now):
+    return max(1, math.ceil(period - now % period))
+
+class MemoryBackend:
+    def __init__(self):
+        # key -> (window, current count, previous count, period)
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, period, now):
+        window = int(now // period)
+        with self._lock:
+            start, current, previous, _ = self.counters.get(key, (window, 0, 0, period))
+            if start != window:
+                previous = current if start == window - 1 else 0
+                current = 0
+            allowed = _estimate(previous, current, period, now) < limit
+            self.counters[key] = (window, current + allowed, previous, period)
+            if len(self.counters) > MAX_MEMORY_KEYS:
+                self._prune(now)
+            return allowed
+
+    def _prune(self, now):
+        # a key whose previous window has passed too carries no weight
+        self.counters = {key: value for key, value in self.counters.items() if (value[0] + 2) * value[3] > now}
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+
+class SQLiteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS ratelimit (key TEXT NOT NULL, window INTEGER NOT NULL, '
+            'count INTEGER NOT NULL, expires REAL NOT NULL, PRIMARY KEY (key, window)) WITHOUT ROWID'
+        )
+
+    def _connection(self):
+        # one connection per thread, and a new one after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def hit(self, key, limit, period, now):
+        window = int(now // period)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            counts = dict(connection.execute(
+                'SELECT window, count FROM ratelimit WHERE key = ? AND window IN (?, ?)', (key, window - 1, window)
+            ).fetchall())
+            allowed = _estimate(counts.get(window - 1, 0), counts.get(window, 0), period, now) < limit
+            if allowed:
+                connection.execute(
+                    'INSERT INTO ratelimit (key, window, count, expires) VALUES (?, ?, 1, ?) '
+                    'ON CONFLICT (key, window) DO UPDATE SET count = count + 1',
+                    (key, window, (window + 2) * period)
+                )
+            if random.random() < 0.001:
+                connection.execute('DELETE FROM ratelimit WHERE expires < ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed
+
+    def clear(self):
+        self._connection().execute('DELETE FROM ratelimit')
+
+class Limiter:
+    def __init__(self):
+        self.backend = None
+        self.enabled = False
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATELIMIT_ENABLED', True)
+        if app.config.get('RATELIMIT_STORAGE') == 'sqlite':
+            path = app.config.get('RATELIMIT_STORAGE_PATH') or os.path.join(app.instance_path, 'ratelimit.sqlite3')
+            self.backend = SQLiteBackend(path)
+        else:
+            self.backend = MemoryBackend()
+
+    def hit(self, name, key, limit):
+        count, period = parse_limit(limit)
+        return self.backend.hit(f'{name}:{key}', count, period, time.time())
+
+    def limit(self, setting, key_func):
+        # decorator; put it right under @bp.route so it runs before anything else
+        def decorator(func):
+            @wraps(func)
+            def inner(*args, **kwargs):
+                limit = current_app.config.get(setting)
+                if self.enabled and limit:
+                    key = key_func()
+                    if key is not None and not self.hit(setting, key, limit):
+                        self.rejected += 1
+                        retry_after = _retry_after(parse_limit(limit)[1], time.time())
+                        return 'Too many requests, try again later', 429, {'Retry-After': str(retry_after)}
+                return func(*args, **kwargs)
+            return inner
+        return decorator
+
+def by_ip():
+    # the address the WSGI server saw; behind a proxy wrap the app in ProxyFix
+    return request.remote_addr or 'unknown'
+
+def by_form(field):
+    def key():
+        value = (request.form.get(field) or '').strip().lower()
+        return value or None
+    return key
+
+def by_user():
+    # straight from the session cookie, without loading the user
+    user_id = session.get('_user_id')
+    return f'user:{user_id}' if user_id else f'ip:{by_ip()}'
+
+limiter = Limiter()
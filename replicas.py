@@ -0,0 +1,108 @@
+#replicas.py
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+import click
+from flask import current_app, g, has_request_context, session
+from flask.cli import with_appcontext
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select
+
+# read replicas. DB_REPLICA_URIS lists extra databases (comma separated)
+# that are registered as the binds replica0, replica1, ... Views marked
+# @read_only send their SELECTs to one replica, picked per request; all
+# other views, every write and anything run outside a request (jobs, CLI)
+# stay on the primary.
+#
+# Read-your-writes: a request that writes marks the browser session, and
+# for REPLICA_STICKY_SECONDS after that its read-only views read from the
+# primary too, so a user never sees a replica that has not caught up with
+# their own order or payment yet. A read-only view that writes switches to
+# the primary for the rest of the request.
+#
+# Replication itself is the database server's job. For local testing point
+# the replicas at SQLite files and copy the primary over them with
+# `flask sync-replicas`.
+
+def replica_uris(config):
+    return [uri.strip() for uri in (config.get('DB_REPLICA_URIS') or '').split(',') if uri.strip()]
+
+def _is_read(clause):
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+def _is_write(clause):
+    # INSERT / UPDATE / DELETE; text() (search, pragmas) is not assumed to write
+    return getattr(clause, 'is_dml', False)
+
+def _sticky():
+    return session.get('primary_until', 0) > time.time()
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or _is_write(clause):
+                g.db_wrote = True
+            elif g.get('db_read_only') and not g.get('db_wrote') and not g.get('db_primary'):
+                replica = _replica(self._db.engines)
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def _replica(engines):
+    if 'db_replica' not in g:
+        keys = [key for key in engines if key is not None and key.startswith('replica')]
+        g.db_replica = random.choice(keys) if keys and not _sticky() else None
+    return engines[g.db_replica] if g.db_replica else None
+
+def read_only(func):
+    # put it right under @bp.route so the login check reads from the replica too
+    @wraps(func)
+    def inner(*args, **kwargs):
+        g.db_read_only = True
+        return func(*args, **kwargs)
+    return inner
+
+@contextmanager
+def primary():
+    # reads inside the block go to the primary even in a read-only view,
+    # for values a later write is compared against
+    previous = g.get('db_primary', False)
+    g.db_primary = True
+    try:
+        yield
+    finally:
+        g.db_primary = previous
+
+def remember_write(response):
+    if g.get('db_wrote') and current_app.config.get('DB_REPLICA_URIS'):
+        session['primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+    return response
+
+@click.command('sync-replicas')
+@with_appcontext
+def sync_replicas_command():
+    """Copy the primary SQLite database over the SQLite replicas."""
+    from models import db
+    primary = db.engine.url
+    if primary.get_backend_name() != 'sqlite':
+        print('The primary is not SQLite, replication is up to the database server')
+        return
+    source = sqlite3.connect(primary.database)
+    try:
+        for key, engine in db.engines.items():
+            if key is None or not key.startswith('replica') or engine.url.get_backend_name() != 'sqlite':
+                continue
+            engine.dispose()
+            target = sqlite3.connect(engine.url.database)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+            print(f'Copied {primary.database} to {engine.url.database}')
+    finally:
+        source.close()
+
+def init_app(app):
+    app.after_request(remember_write)
@@ -1,52 +1,72 @@
 # user_auth.py
-from flask import render_template, request, redirect, url_for, flash, session
-from main import app
-from models import db, User, Section, Book, Issue, Cart, Payment, Transaction, Order
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, jsonify, current_app, stream_with_context
+from models import db, User, Section, Book, Issue, Cart, Payment, Order, Upload, DEFAULT_COPIES
+from catalogue import catalogue_page
+import search
+import analytics
+import versions
+import bulk
+import storage
+from checkout import checkout_cart, StaleCart
+import carts
+import archive
+from inventory import OutOfStock
+from billing import get_payment, confirm_payment
+from instrumentation import query_budget
+from sqlalchemy.orm import joinedload
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from functools import wraps
-from datetime import datetime, timedelta
-from flask_login import current_user 
-import csv
+from datetime import datetime, timedelta, date
+from flask_login import current_user, login_user, logout_user
+from identity import remember
+from ratelimit import limiter, by_ip, by_form, by_user
+from replicas import read_only
 import os
 from uuid import uuid4
 
-@app.route('/')
+bp = Blueprint('routes', __name__)
+
+@bp.route('/')
 def index():
     return render_template('home.html')
 
-@app.route('/login')
+@bp.route('/login')
 def login():
     return render_template('user/user.html')
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
+@limiter.limit('RATELIMIT_LOGIN_IP', by_ip)
+@limiter.limit('RATELIMIT_LOGIN_USER', by_form('userName'))
 def login_post():
     username = request.form.get('userName')
     password = request.form.get('password')
 
     if not username or not password:
         flash('Please fill out all fields')
-        return redirect(url_for('login'))
+        return redirect(url_for('routes.login'))
     
     user = User.query.filter_by(username=username).first()
     
     if not user:
         flash('Username does not exist')
-        return redirect(url_for('login'))
+        return redirect(url_for('routes.login'))
     
     if not check_password_hash(user.passhash, password):
         flash('Incorrect password')
-        return redirect(url_for('login'))
+        return redirect(url_for('routes.login'))
     
-    session['user_id'] = user.id
+    login_user(remember(user))
+    carts.forget()
     flash('Login successful')
-    return redirect(url_for('user_dash'))
+    return redirect(url_for('routes.user_dash'))
 
-@app.route('/register')
+@bp.route('/register')
 def register():
     return render_template('user/user.html')
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register_post():
     username = request.form.get('email')
     username = request.form.get('userName')
@@ -57,127 +77,216 @@ def register_post():
 
     if not username or not password or not confirm_password:
         flash('Please fill out all fields')
-        return redirect(url_for('register'))
+        return redirect(url_for('routes.register'))
     
     if password != confirm_password:
         flash('Passwords do not match')
-        return redirect(url_for('register'))
+        return redirect(url_for('routes.register'))
     
     user = User.query.filter_by(username=username).first()
 
     if user:
         flash('Username already exists')
-        return redirect(url_for('register'))
+        return redirect(url_for('routes.register'))
     
     password_hash = generate_password_hash(password)
     
     new_user = User(username=username, passhash=password_hash, name=name)
     db.session.add(new_user)
     db.session.commit()
-    return redirect(url_for('login'))
+    return redirect(url_for('routes.login'))
+
+def parse_copies(value, default=DEFAULT_COPIES):
+    if not value:
+        return default
+    try:
+        copies = int(value)
+    except ValueError:
+        return None
+    return copies if copies >= 0 else None
 
 # decorator for auth_required
+# identity comes from flask_login (identity.load_identity), cached per user id
 
 def auth_required(func):
     @wraps(func)
     def inner(*args, **kwargs):
-        if 'user_id' in session:
+        if current_user.is_authenticated:
             return func(*args, **kwargs)
         else:
             flash('Please login to continue')
-            return redirect(url_for('login'))
+            return redirect(url_for('routes.login'))
     return inner
 
 # decorator for admin_required
 def admin_required(func):
     @wraps(func)
     def inner(*args, **kwargs):
-        if 'user_id' not in session:
+        if not current_user.is_authenticated:
             flash('Please login to continue')
-            return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user.is_admin:
+            return redirect(url_for('routes.login'))
+        if not current_user.is_admin:
             flash('You are not authorized to access this page')
-            return redirect(url_for('home'))
+            return redirect(url_for('routes.index'))
         return func(*args, **kwargs)
     return inner
 
-@app.route('/logout')
+@bp.route('/logout')
 @auth_required
 def logout():
-    session.pop('user_id')
-    return redirect(url_for('index'))
+    logout_user()
+    carts.forget()
+    return redirect(url_for('routes.index'))
 
  #--- admin pages
-@app.route('/admin_login')
+@bp.route('/admin_login')
 def admin_login():
     return render_template('librarian/librarian.html')
 
-@app.route('/admin_login', methods=['POST'])
+@bp.route('/admin_login', methods=['POST'])
+@limiter.limit('RATELIMIT_LOGIN_IP', by_ip)
+@limiter.limit('RATELIMIT_LOGIN_USER', by_form('username'))
 def admin_login_post():
     username = request.form.get('username')
     password = request.form.get('password')
 
     if not username or not password:
         flash('Please fill out all fields')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('routes.admin_login'))
     
     user = User.query.filter_by(username=username).first()
     
     if not user:
         flash('Username does not exist')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('routes.admin_login'))
     
     if not check_password_hash(user.passhash, password):
         flash('Incorrect password')
-        return redirect(url_for('admin_login'))
+        return redirect(url_for('routes.admin_login'))
     
-    session['user_id'] = user.id
+    login_user(remember(user))
     flash('Login successful')
-    return redirect(url_for('admin_dash'))
+    return redirect(url_for('routes.admin_dash'))
 
-@app.route('/admin_dash')
+@bp.route('/admin_dash')
 @admin_required
+@query_budget(4)
 def admin_dash():
-    
-    sections = Section.query.all()
-    for section in sections:
-       print(section.books)
-    section_names = [section.name for section in sections]
-    section_sizes = [len(section.books) for section in sections]
-    return render_template('librarian/librarian_dash.html', sections=sections, section_names=section_names, section_sizes=section_sizes)
+    stats = analytics.section_stats()
+    sections = stats['sections']
+    section_names = [section['name'] for section in sections]
+    section_sizes = [section['books'] for section in sections]
+    section_revenue = [section['revenue'] for section in sections]
+    return render_template('librarian/librarian_dash.html', sections=sections, totals=stats['totals'], section_names=section_names, section_sizes=section_sizes, section_revenue=section_revenue)
+
+@bp.route('/admin_dash/analytics')
+@admin_required
+@query_budget(4)
+def admin_analytics():
+    return jsonify(analytics.section_stats())
     
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pdf'
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/book/<int:id>/upload', methods=['POST', 'PUT'])
+@admin_required
+def upload_file(id):
+    book = Book.query.get(id)
+    if not book:
+        return upload_failed('Book does not exist', 404)
+
+    # enforced while the body is read, so chunked bodies are cut off too;
+    # multipart files are parsed straight into the upload folder
+    limit = current_app.config.get('MAX_UPLOAD_BYTES')
+    if limit:
+        request.body_limit = limit + 64 * 1024
+    request.file_factory = storage.Spool
+
+    try:
+        if request.method == 'PUT':
+            # raw body upload, streamed straight from the socket
+            stream, filename = request.stream, request.args.get('filename')
+        else:
+            if 'file' not in request.files:
+                return upload_failed('No file part', 400, book)
+            file = request.files['file']
+            if file.filename == '':
+                return upload_failed('No selected file', 400, book)
+            if not allowed_file(file.filename):
+                return upload_failed('Invalid file type.', 415, book)
+            stream, filename = file.stream, secure_filename(file.filename)
+        storage.attach(book, stream, filename)
+    except RequestEntityTooLarge:
+        db.session.rollback()
+        return upload_failed('File is too large', 413, book)
+    except storage.StorageError as e:
+        db.session.rollback()
+        return upload_failed(str(e), e.status, book)
+    versions.bump(versions.CATALOGUE)
+    db.session.commit()
+
+    if request.method == 'PUT':
+        return '', 204
+    flash('File uploaded successfully')
+    return redirect(url_for('routes.show_section', id=book.section_id))
+
+def upload_failed(message, status, book=None):
+    # PUT clients get the status, the form gets a flash message
+    if request.method == 'PUT':
+        return message, status
+    flash(message)
+    if book is None:
+        return redirect(url_for('routes.admin_dash'))
+    return redirect(url_for('routes.show_section', id=book.section_id))
+
+@bp.route('/book/import', methods=['POST'])
 @admin_required
-def upload_file():
-    if 'file' not in request.files:
-        flash('No file part')
-        return redirect(request.url)
+def import_books():
+    return bulk_import(bulk.import_books)
 
-    file = request.files['file']
-    if file.filename == '':
+@bp.route('/section/import', methods=['POST'])
+@admin_required
+def import_sections():
+    return bulk_import(bulk.import_sections)
+
+def bulk_import(importer):
+    file = request.files.get('file')
+    if not file or file.filename == '':
         flash('No selected file')
-        return redirect(request.url)
+        return redirect(url_for('routes.admin_dash'))
+    if not file.filename.lower().endswith('.csv'):
+        flash('Invalid file type.')
+        return redirect(url_for('routes.admin_dash'))
+
+    report = importer(file.stream)
+    if report.inserted:
+        versions.bump(versions.CATALOGUE)
+        db.session.commit()
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(report.as_dict())
+    return render_template('librarian/import_report.html', report=report, filename=file.filename)
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        flash('File uploaded successfully')
-        return redirect(url_for('upload_file'))
+@bp.route('/book/export')
+@admin_required
+def export_books():
+    return csv_response(bulk.export_books(), 'books.csv')
+
+@bp.route('/section/export')
+@admin_required
+def export_sections():
+    return csv_response(bulk.export_sections(), 'sections.csv')
 
-    flash('Invalid file type.')
-    return redirect(request.url)
+def csv_response(lines, filename):
+    return Response(stream_with_context(lines), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
-@app.route('/section/add')
+@bp.route('/section/add')
 @admin_required
 def add_section():
     return render_template('section/add.html')
 
-@app.route('/section/add', methods=['POST'])
+@bp.route('/section/add', methods=['POST'])
 @admin_required
 def add_section_post():
     name = request.form.get('name')
@@ -186,41 +295,48 @@ def add_section_post():
 
     if not name or not description:
         flash('Please fill out all fields')
-        return redirect(url_for('add_section_form'))
+        return redirect(url_for('routes.add_section'))
 
     section = Section(name=name, date_created=date_created, description=description)
     db.session.add(section)
+    db.session.flush()
+    search.index_section(section)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Section added successfully')
-    return redirect(url_for('admin_dash'))
+    return redirect(url_for('routes.admin_dash'))
 
-@app.route('/section/<int:id>/')
+@bp.route('/section/<int:id>/')
+@read_only
 @admin_required
+@query_budget(3)
 def show_section(id):
     section = Section.query.get(id)
     if not section:
         flash('Sectiondoes not exist')
-        return redirect(url_for('admin_dash'))
-    return render_template('section/show.html', section=section)
+        return redirect(url_for('routes.admin_dash'))
+    # loaded up front, the fragment key carries their available counts
+    books = Book.query.filter_by(section_id=id).order_by(Book.id).all()
+    return render_template('section/show.html', section=section, books=books)
 
 
-@app.route('/section/<int:id>/edit')
+@bp.route('/section/<int:id>/edit')
 @admin_required
 def edit_section(id):
     section=Section.query.get(id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
     return render_template('section/edit.html', section=section)
 
-@app.route('/section/<int:id>/edit', methods=['POST'])
+@bp.route('/section/<int:id>/edit', methods=['POST'])
 @admin_required
 def edit_section_post(id):
     section = Section.query.get(id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
 
     name = request.form.get('name')
     date_created_str = request.form.get('date_created')
@@ -228,56 +344,60 @@ def edit_section_post(id):
 
     if not name or not date_created_str or not description:
         flash('Please fill all the fields')
-        return redirect(url_for('edit_section', id=id))
+        return redirect(url_for('routes.edit_section', id=id))
 
     try:
         date_created = datetime.strptime(date_created_str, '%Y-%m-%d').date()
     except ValueError:
         flash('Invalid date format')
-        return redirect(url_for('edit_section', id=id))
+        return redirect(url_for('routes.edit_section', id=id))
 
     section.name = name
     section.date_created = date_created
     section.description = description
+    search.index_section(section)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Section updated successfully')
-    return redirect(url_for('admin_dash'))
+    return redirect(url_for('routes.admin_dash'))
 
-@app.route('/section/<int:id>/delete')
+@bp.route('/section/<int:id>/delete')
 @admin_required
 def delete_section(id):
     section = Section.query.get(id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
     return render_template('section/delete.html', section=section)
 
-@app.route('/section/<int:id>/delete', methods=['POST'])
+@bp.route('/section/<int:id>/delete', methods=['POST'])
 @admin_required
 def delete_section_post(id):
     section = Section.query.get(id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
+    search.remove_section(section.id)
     db.session.delete(section)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Section deleted successfully')
-    return redirect(url_for('admin_dash'))
+    return redirect(url_for('routes.admin_dash'))
 
-@app.route('/book/add/<int:section_id>')
+@bp.route('/book/add/<int:section_id>')
 @admin_required
 def add_book(section_id):
     sections = Section.query.all()
     section = Section.query.get(section_id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('librarian_dash'))
+        return redirect(url_for('routes.admin_dash'))
     now = datetime.now().strftime('%Y-%m-%d')
-    return render_template('books/add.html', section=section, sections=sections, now=now)
+    return render_template('books/add.html', section=section, sections=sections, now=now, default_copies=DEFAULT_COPIES)
 
-@app.route('/book/add/', methods=['POST'])
+@bp.route('/book/add/', methods=['POST'])
 @admin_required
 def add_book_post():
     name = request.form.get('name')
@@ -289,36 +409,44 @@ def add_book_post():
     section = Section.query.get(section_id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
 
     if not name or not content or not author or not price:
         flash('Please fill out all fields')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
     try:
         price = float(price)
         
     except ValueError:
         flash('Invalid price')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
 
     if price <= 0:
         flash('Invalid price')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
+
+    copies = parse_copies(request.form.get('copies'))
+    if copies is None:
+        flash('Invalid number of copies')
+        return redirect(url_for('routes.add_book', section_id=section_id))
     
-    book = Book(name=name, content=content, author=author, price=price, section=section)
+    book = Book(name=name, content=content, author=author, price=price, section=section, copies=copies, available=copies)
     db.session.add(book)
+    db.session.flush()
+    search.index_book(book)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Book added successfully')
-    return redirect(url_for('show_section', id=section_id))
+    return redirect(url_for('routes.show_section', id=section_id))
 
-@app.route('/book/<int:id>/edit')
+@bp.route('/book/<int:id>/edit')
 def edit_book(id):
     sections = Section.query.all()
     book = Book.query.get(id)
     return render_template('books/edit.html', sections=sections, book = book)
 
-@app.route('/book/<int:id>/edit', methods=['POST'])
+@bp.route('/book/<int:id>/edit', methods=['POST'])
 def edit_book_post(id):
     name = request.form.get('name')
     content = request.form.get('content')
@@ -329,230 +457,273 @@ def edit_book_post(id):
     section = Section.query.get(section_id)
     if not section:
         flash('Section does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
 
     if not name or not content or not author or not price:
         flash('Please fill out all fields')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
     try:
         price = float(price)
     except ValueError:
         flash('Invalid price')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
 
     if price <= 0:
         flash('Invalid price')
-        return redirect(url_for('add_book', section_id=section_id))
+        return redirect(url_for('routes.add_book', section_id=section_id))
     
     book = Book.query.get(id)
+    copies = parse_copies(request.form.get('copies'), book.copies)
+    if copies is None:
+        flash('Invalid number of copies')
+        return redirect(url_for('routes.edit_book', id=id))
+    issued = book.copies - book.available
+    if copies < issued:
+        flash(f'{issued} copies are issued, the book needs at least that many')
+        return redirect(url_for('routes.edit_book', id=id))
+
     book.name = name
     book.content = content
     book.author = author
     book.price = price
     book.section_id = section_id
+    # relative to the stored value, checkouts may be reserving copies meanwhile
+    book.available = Book.available + (copies - book.copies)
+    book.copies = copies
+    search.index_book(book)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Book edited successfully')
-    return redirect(url_for('show_section', id=section_id))
+    return redirect(url_for('routes.show_section', id=section_id))
 
 
-@app.route('/book/<int:id>/delete')
+@bp.route('/book/<int:id>/delete')
 def delete_book(id):
     book = Book.query.get(id)
     if not book:
         flash('Book does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
     return render_template('books/delete.html', book=book)
 
-@app.route('/book/<int:id>/delete', methods=['POST'])
+@bp.route('/book/<int:id>/delete', methods=['POST'])
 @admin_required
 def delete_book_post(id):
     book = Book.query.get(id)
     if not book:
         flash('Book does not exist')
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
     section_id = book.section.id
+    search.remove_book(book.id)
     db.session.delete(book)
+    versions.bump(versions.CATALOGUE)
     db.session.commit()
 
     flash('Book deleted successfully')
-    return redirect(url_for('show_section', id=section_id))
+    return redirect(url_for('routes.show_section', id=section_id))
 
 # --- user pages
 
-@app.route('/user_dash')
+@bp.route('/book/<int:id>/read')
+@auth_required
+def read_book(id):
+    # readers fetch pages by byte range, so this runs once per range request:
+    # one query for the issue check and the file together
+    today = date.today()
+    active_issue = db.session.query(Issue.id).join(Issue.orders).filter(
+        Order.book_id == Book.id, Issue.user_id == current_user.id,
+        Issue.access == True, Issue.return_date >= today
+    ).exists()
+    query = db.session.query(Upload, Book.name).join(Book.upload).filter(Book.id == id)
+    if not current_user.is_admin:
+        query = query.filter(active_issue)
+    row = query.first()
+    if not row:
+        flash('Book is not issued to you or has no file')
+        return redirect(url_for('routes.user_dash'))
+    upload, name = row
+    return storage.send(upload, download_name=f'{secure_filename(name) or "book"}.pdf')
+
+
+@bp.route('/user_dash')
+@read_only
 @auth_required
 def user_dash():
-    user = User.query.get(session['user_id'])
+    user = current_user
     if user.is_admin:
-        return redirect(url_for('admin_dash'))
+        return redirect(url_for('routes.admin_dash'))
     
-    sections = Section.query.all()
-
     sname = request.args.get('sname') or ''
     bname = request.args.get('bname') or ''
     price = request.args.get('price')
+    after = request.args.get('after')
     
     if price:
         try:
             price = float(price)
         except ValueError:
             flash('Invalid Price')
-            return redirect(url_for('user_dash'))
+            return redirect(url_for('routes.user_dash'))
         if price <= 0:
             flash('Invalid Price')
-            return redirect(url_for('user_dash'))
-    
-    #parameter = request.args.get('parameter')
-    #query = request.args.get('query')
+            return redirect(url_for('routes.user_dash'))
     
-    ##parameters = {'cname': 'Category Name','pname': 'Product Name','price': 'Max Price'}
-
-    ##if parameter == 'cname':
-        #categories = Category.query.filter(Category.name.ilike(f'%{query}%')).all()
-        #return render_template('user_dash.html', categories=categories, query=query, parameters=parameters)
-    ##elif parameter == 'pname':
-        #return render_template('user_dash.html', categories=categories, param=parameter, pname=query, parameters=parameters, query=query)
-    ##elif parameter == 'price':
-        #query = float(query)
-        #return render_template('user_dash.html', categories=categories, param=parameter, price=query, parameters=parameters, query=query)
+    page = catalogue_page(sname=sname, bname=bname, max_price=price, after=after)
+    issues, older_issues = archive.issue_page(current_user.id, request.args.get('issues_before'))
     
-    if sname:
-        sections = Section.query.filter(Section.name.ilike(f'%{sname}%')).all()
-    issues = [] 
-    if not user.is_admin:
-        issues = Issue.query.filter_by(user_id=session['user_id']).all()
+    return render_template('user/user_dash.html', user=user, sections=page.sections, next_cursor=page.next_cursor, sname=sname, bname=bname,price=price, issues=issues, older_issues=older_issues)
 
-    payments = Payment.query.all()
-    
-    return render_template('user/user_dash.html', user=user, sections=sections, sname=sname, bname=bname,price=price, issues=issues, payments=payments)#, parameters=parameters)
+@bp.route('/search')
+@auth_required
+def search_books():
+    query = request.args.get('q') or ''
+    try:
+        limit = int(request.args.get('limit') or 20)
+    except ValueError:
+        limit = 20
+    limit = max(1, min(limit, 100))
+    return jsonify({'query': query, 'results': search.search(query, limit)})
 
-@app.route('/add_to_cart/<int:book_id>', methods = ['POST'])
+@bp.route('/add_to_cart/<int:book_id>', methods = ['POST'])
+@limiter.limit('RATELIMIT_CART', by_user)
 @auth_required
 def add_to_cart(book_id):
+    if carts.session_mode():
+        error = carts.add(book_id, request.form.get('quantity'))
+        flash(error or 'Product added to cart succesfully')
+        return redirect(url_for('routes.user_dash'))
+
     book = Book.query.get(book_id)
     if not book:
         flash('Book does not exist')
-        return redirect(url_for('user_dash'))
+        return redirect(url_for('routes.user_dash'))
     quantity = request.form.get('quantity')
     try:
         quantity = int(quantity)
     except ValueError:
         flash('Invalid quantity')
-        return redirect(url_for('user_dash'))
-    if quantity <= 0 or quantity > 5:
-        flash(f'Invalid quantity, should be between 1 and 6')
-        return redirect(url_for('user_dash'))
+        return redirect(url_for('routes.user_dash'))
+    if quantity <= 0 or quantity > book.available:
+        flash(f'Invalid quantity, {book.available} copies available')
+        return redirect(url_for('routes.user_dash'))
     
-    cart = Cart.query.filter_by(user_id=session['user_id'], book_id=book_id).first()
+    cart = Cart.query.filter_by(user_id=current_user.id, book_id=book_id).first()
 
     if cart:
-        if quantity + cart.quantity > 5:
-            flash(f'Invalid quantity, should be between 1 and 6')
-            return redirect(url_for('user_dash'))
+        if quantity + cart.quantity > book.available:
+            flash(f'Invalid quantity, {book.available} copies available')
+            return redirect(url_for('routes.user_dash'))
         cart.quantity += quantity
+        cart.updated = datetime.now()
     else:
-        cart = Cart(user_id=session['user_id'], book_id=book_id, quantity=quantity)
+        cart = Cart(user_id=current_user.id, book_id=book_id, quantity=quantity, updated=datetime.now())
         db.session.add(cart)
     
     db.session.commit()
 
     flash('Product added to cart succesfully')
-    return redirect(url_for('user_dash'))
+    return redirect(url_for('routes.user_dash'))
 
-@app.route('/cart')
+# session carts also read the user version for checkout
+@bp.route('/cart')
+@read_only
 @auth_required
+@query_budget(2)
 def cart():
-    carts = Cart.query.filter_by(user_id=session['user_id']).all()
-    total = sum([cart.book.price * cart.quantity for cart in carts])
-    return render_template('user/cart.html', carts=carts, total=total)
-
-@app.route('/cart/<int:id>/delete', methods=['POST'])
+    if carts.session_mode():
+        lines = carts.lines(current_user.id)
+    else:
+        lines = Cart.query.filter_by(user_id=current_user.id).options(joinedload(Cart.book)).all()
+    short = [line.book.name for line in lines if line.quantity > line.book.available]
+    if short:
+        flash(f'Not enough copies available of: {", ".join(short)}')
+    total = sum([line.book.price * line.quantity for line in lines])
+    return render_template('user/cart.html', carts=lines, total=total)
+
+@bp.route('/cart/<int:id>/delete', methods=['POST'])
 @auth_required
 def delete_cart(id):
+    # session carts: id is the book id
+    if carts.session_mode():
+        flash('Cart deleted successfully' if carts.remove(id) else 'Cart does not exist')
+        return redirect(url_for('routes.cart'))
+
     cart = Cart.query.get(id)
     if not cart:
         flash('Cart does not exist')
-        return redirect(url_for('cart'))
-    if cart.user_id != session['user_id']:
+        return redirect(url_for('routes.cart'))
+    if cart.user_id != current_user.id:
         flash('You are not authorized to access this page')
-        return redirect(url_for('cart'))
+        return redirect(url_for('routes.cart'))
     db.session.delete(cart)
     db.session.commit()
     flash('Cart deleted successfully')
-    return redirect(url_for('cart'))
+    return redirect(url_for('routes.cart'))
 
-@app.route('/checkout', methods=['POST'])
+# 7 statements, plus 3 for the savepoint that creates the user's version
+# row on their first checkout and 1 when a title runs out
+@bp.route('/checkout', methods=['POST'])
+@limiter.limit('RATELIMIT_CHECKOUT', by_user)
 @auth_required
+@query_budget(11)
 def checkout():
-    carts = Cart.query.filter_by(user_id=session['user_id']).all()
-    if not carts:
-        flash('Cart is empty')
-        return redirect(url_for('cart'))
-
-    transaction = Transaction(user_id=session['user_id'], datetime=datetime.now())
-    for cart in carts:
-        order = Order(transaction=transaction, book=cart.book, quantity=cart.quantity, price=cart.book.price)
-        db.session.add(order)
-        db.session.delete(cart)
-    db.session.add(transaction)
-    db.session.commit()
-    order_detail = Order(id=order.id)
-    if order_detail:
-        issue_date=datetime.now()
-        return_date = issue_date + timedelta(days=7)
-        if datetime.now() >= issue_date and datetime.now() <= return_date:
-                access = True
+    try:
+        if carts.session_mode():
+            transaction_id = carts.checkout(current_user.id)
         else:
-                access = False
-        issue = Issue(user_id=session['user_id'], 
-                      order_id=order_detail.id,
-                      issue=issue_date,
-                      return_date=return_date,
-                      access=access)
-        db.session.add(issue)
-        db.session.commit()
-    else:
-        flash('Issue date cannot be created.')
+            transaction_id = checkout_cart(current_user.id)
+    except OutOfStock as error:
+        names = ', '.join(name for name, in db.session.query(Book.name).filter(Book.id.in_(error.book_ids)))
+        flash(f'Not enough copies available of: {names or "books no longer in the catalogue"}')
+        return redirect(url_for('routes.cart'))
+    except StaleCart:
+        carts.forget()
+        flash('This cart has already been checked out')
+        return redirect(url_for('routes.orders'))
+    if not transaction_id:
+        flash('Cart is empty')
+        return redirect(url_for('routes.cart'))
 
-    transaction = Transaction.query.filter_by(user_id=session['user_id']).all()[0]
     flash('Order placed successfully')
-    return redirect(url_for('payments', id=transaction.id))
+    return redirect(url_for('routes.payments', id=transaction_id))
 
-@app.route('/payments/<int:id>')
+@bp.route('/payments/<int:id>')
 @auth_required
+@query_budget(3)
 def payments(id):
-    transaction = Transaction.query.filter_by(user_id=session['user_id'], id =id).first()
-    total = sum([order.price * order.quantity for order in transaction.orders])
-    GST = total * 0.18
-    amount_payable = total + GST
-    payment = Payment(user_id=session['user_id'], transaction=transaction, amount_payable=amount_payable, status='success', datetime=datetime.now())
-    db.session.add(payment)
-    db.session.commit()
+    # one statement; three the first time an old transaction gets its payment
+    payment = get_payment(current_user.id, id)
     if not payment:
         flash('Payment not found')
-        return redirect(url_for('cart'))
+        return redirect(url_for('routes.cart'))
 
-    return render_template('payments.html', payment=payment, total=total, GST=GST, amount_payable=amount_payable)
+    return render_template('payments.html', payment=payment, total=payment.total, GST=payment.gst, amount_payable=payment.amount_payable)
 
-@app.route('/payments', methods=['POST'])
+@bp.route('/payments/<int:id>', methods=['POST'])
 @auth_required
-def payments_post():
-    user = User.query.get(session['user_id'])
-    payment = Payment.query.get()
+def payments_post(id):
+    payment = Payment.query.filter_by(transaction_id=id, user_id=current_user.id).first()
     if not payment:
         flash('Payment not found')
-        return redirect(url_for('cart'))
+        return redirect(url_for('routes.cart'))
 
-    flash('Payment successful')
-    print(url_for('user_dash'))
-    return redirect(url_for('user_dash', user=user))
+    if confirm_payment(current_user.id, id):
+        flash('Payment successful')
+    else:
+        flash('Payment already completed')
+    return redirect(url_for('routes.user_dash'))
     
 
-@app.route('/orders')
+@bp.route('/orders')
+@read_only
 @auth_required
+@query_budget(4)
 def orders():
-    transactions = Transaction.query.filter_by(user_id=session['user_id']).order_by(Transaction.datetime.desc()).all()
-    return render_template('user/orders.html', transactions=transactions)
+    # a page of history at a time, continuing into the archive, rendered
+    # from the stored totals; ?open=<id> adds the lines of one transaction
+    transactions, older = archive.order_page(current_user.id, request.args.get('before'))
+    opened = request.args.get('open', type=int)
+    lines = archive.order_lines(current_user.id, opened) if opened else []
+    return render_template('user/orders.html', transactions=transactions, older=older, opened=opened, lines=lines)
 
 
@@ -0,0 +1,155 @@
+#search.py
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text, Integer
+from models import db, Book, Section
+
+# full-text index over books and sections, backed by an SQLite FTS5 table.
+# rowid encodes the document: book ids are even (id * 2), section ids odd
+# (id * 2 + 1), so updates and deletes are rowid lookups and never scan.
+
+BOOK = 0
+SECTION = 1
+
+def enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def create_index():
+    if not enabled():
+        return
+    exists = db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'"
+    )).first()
+    if exists:
+        return
+    db.session.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "title, author, body, tokenize='unicode61 remove_diacritics 2')"
+    ))
+    db.session.commit()
+    # first boot on an existing library, index what is already there
+    rebuild()
+
+def _rowid(kind, id):
+    return id * 2 + kind
+
+def _put(kind, id, title, author, body):
+    rowid = _rowid(kind, id)
+    db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': rowid})
+    db.session.execute(text(
+        'INSERT INTO search_index (rowid, title, author, body) VALUES (:rowid, :title, :author, :body)'
+    ), {'rowid': rowid, 'title': title, 'author': author, 'body': body})
+
+# the sync helpers run inside the caller's transaction, so the index is
+# committed (or rolled back) together with the row it describes
+
+def index_book(book):
+    if enabled():
+        _put(BOOK, book.id, book.name, book.author, book.content)
+
+def index_section(section):
+    if enabled():
+        _put(SECTION, section.id, section.name, '', section.description)
+
+def index_books(rows):
+    # rows of (id, name, author, content) for freshly inserted books
+    if enabled() and rows:
+        db.session.execute(text(
+            'INSERT INTO search_index (rowid, title, author, body) VALUES (:rowid, :title, :author, :body)'
+        ), [{'rowid': _rowid(BOOK, id), 'title': name, 'author': author, 'body': content} for id, name, author, content in rows])
+
+def index_sections(rows):
+    # rows of (id, name, description) for freshly inserted sections
+    if enabled() and rows:
+        db.session.execute(text(
+            "INSERT INTO search_index (rowid, title, author, body) VALUES (:rowid, :title, '', :body)"
+        ), [{'rowid': _rowid(SECTION, id), 'title': name, 'body': description} for id, name, description in rows])
+
+def remove_book(book_id):
+    if enabled():
+        db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': _rowid(BOOK, book_id)})
+
+def remove_section(section_id):
+    if not enabled():
+        return
+    # books go with their section through the cascade, drop their documents too
+    db.session.execute(text(
+        'DELETE FROM search_index WHERE rowid IN (SELECT id * 2 FROM book WHERE section_id = :section_id)'
+    ), {'section_id': section_id})
+    db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': _rowid(SECTION, section_id)})
+
+def rebuild():
+    if not enabled():
+        return 0
+    db.session.execute(text('DELETE FROM search_index'))
+    db.session.execute(text(
+        'INSERT INTO search_index (rowid, title, author, body) '
+        'SELECT id * 2, name, author, content FROM book'
+    ))
+    db.session.execute(text(
+        "INSERT INTO search_index (rowid, title, author, body) "
+        "SELECT id * 2 + 1, name, '', description FROM section"
+    ))
+    db.session.commit()
+    return db.session.execute(text('SELECT count(*) FROM search_index')).scalar()
+
+def match_expression(query, column=None):
+    # every word becomes a quoted prefix term, so user input can never be
+    # parsed as FTS5 syntax
+    terms = [word.replace('"', '""') for word in query.split()]
+    expression = ' '.join(f'"{term}"*' for term in terms if term)
+    if column and expression:
+        expression = f'{column} : ({expression})'
+    return expression
+
+def book_ids_matching(query, column=None):
+    # subquery of book ids, used by the catalogue to filter without LIKE
+    return text(
+        'SELECT rowid / 2 AS id FROM search_index WHERE search_index MATCH :expression AND rowid % 2 = 0'
+    ).bindparams(expression=match_expression(query, column)).columns(id=Integer)
+
+def search(query, limit=20):
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if not enabled():
+        return _search_like(query, limit)
+    rows = db.session.execute(text(
+        "SELECT rowid, bm25(search_index, 10.0, 5.0, 1.0) AS score, "
+        "snippet(search_index, 2, '<b>', '</b>', '...', 12) AS snippet "
+        "FROM search_index WHERE search_index MATCH :expression "
+        "ORDER BY score LIMIT :limit"
+    ), {'expression': expression, 'limit': limit}).all()
+
+    book_ids = [row.rowid // 2 for row in rows if row.rowid % 2 == BOOK]
+    section_ids = [row.rowid // 2 for row in rows if row.rowid % 2 == SECTION]
+    books = {book.id: book for book in Book.query.filter(Book.id.in_(book_ids))} if book_ids else {}
+    sections = {section.id: section for section in Section.query.filter(Section.id.in_(section_ids))} if section_ids else {}
+
+    results = []
+    for row in rows:
+        if row.rowid % 2 == BOOK and row.rowid // 2 in books:
+            book = books[row.rowid // 2]
+            results.append({'type': 'book', 'id': book.id, 'name': book.name, 'author': book.author,
+                            'section_id': book.section_id, 'snippet': row.snippet, 'score': row.score})
+        elif row.rowid % 2 == SECTION and row.rowid // 2 in sections:
+            section = sections[row.rowid // 2]
+            results.append({'type': 'section', 'id': section.id, 'name': section.name,
+                            'snippet': row.snippet, 'score': row.score})
+    return results
+
+def _search_like(query, limit):
+    # servers without FTS5 get the old substring behaviour
+    books = Book.query.filter(Book.name.ilike(f'%{query}%')).limit(limit).all()
+    sections = Section.query.filter(Section.name.ilike(f'%{query}%')).limit(limit).all()
+    return [{'type': 'book', 'id': book.id, 'name': book.name, 'author': book.author,
+             'section_id': book.section_id, 'snippet': book.content, 'score': None} for book in books] + \
+           [{'type': 'section', 'id': section.id, 'name': section.name,
+             'snippet': section.description, 'score': None} for section in sections]
+
+@click.command('search-rebuild')
+@with_appcontext
+def search_rebuild_command():
+    """Rebuild the full-text search index from the book and section tables."""
+    count = rebuild()
+    print(f'Indexed {count} documents')
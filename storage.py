@@ -0,0 +1,194 @@
+#storage.py
+import os
+import tempfile
+from datetime import datetime
+from hashlib import sha256
+import click
+from flask import Request, current_app, send_file, make_response
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+from models import db, Upload, Book
+
+# book files on disk, content addressed. An upload is copied to a temporary
+# file in fixed size chunks while it is hashed, then renamed to
+# <folder>/<aa>/<sha256>.pdf. A file that is already stored is only
+# referenced again, never written twice.
+#
+# Multipart uploads are parsed straight into such a temporary file (a
+# Spool) instead of werkzeug's own, so the body reaches the disk once.
+# The size limit is applied to the request body while it is read, which
+# also covers chunked requests that carry no Content-Length.
+
+CHUNK_SIZE = 64 * 1024
+PDF_MAGIC = b'%PDF-'
+
+class StorageError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def upload_folder():
+    return current_app.config.get('UPLOAD_FOLDER') or os.path.join(current_app.instance_path, 'uploads')
+
+def full_path(upload):
+    return os.path.join(upload_folder(), upload.path)
+
+class UploadRequest(Request):
+    # lets a view raise the body limit and pick where multipart files are
+    # written, before it first touches the body
+    body_limit = None
+    file_factory = None
+
+    @property
+    def max_content_length(self):
+        if self.body_limit is not None:
+            return self.body_limit
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.file_factory:
+            return self.file_factory()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+class Spool:
+    # temporary file in the upload folder, hashed as it is written
+    def __init__(self):
+        folder = os.path.join(upload_folder(), 'tmp')
+        os.makedirs(folder, exist_ok=True)
+        handle, self.path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self.file = os.fdopen(handle, 'w+b')
+        self.hasher = sha256()
+        self.size = 0
+        self.claimed = False
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        # the request closes its files when it ends; a spool that was not
+        # stored is removed with it
+        self.file.close()
+        if not self.claimed:
+            os.unlink(self.path)
+
+    def finish(self, limit):
+        self.file.seek(0)
+        magic = self.file.read(len(PDF_MAGIC))
+        self.file.close()
+        if self.size == 0:
+            raise StorageError('File is empty')
+        if limit and self.size > limit:
+            raise StorageError('File is too large', 413)
+        if magic != PDF_MAGIC:
+            raise StorageError('File is not a PDF', 415)
+        # store() renames or removes it from here on
+        self.claimed = True
+        return self.path, self.hasher.hexdigest(), self.size
+
+def _spool(stream, folder, limit):
+    os.makedirs(os.path.join(folder, 'tmp'), exist_ok=True)
+    hasher = sha256()
+    size = 0
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.join(folder, 'tmp'), suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0 and not chunk.startswith(PDF_MAGIC):
+                    raise StorageError('File is not a PDF', 415)
+                size += len(chunk)
+                if limit and size > limit:
+                    raise StorageError('File is too large', 413)
+                hasher.update(chunk)
+                tmp.write(chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if size == 0:
+        os.unlink(tmp_path)
+        raise StorageError('File is empty')
+    return tmp_path, hasher.hexdigest(), size
+
+def store(stream, name=None):
+    folder = upload_folder()
+    limit = current_app.config.get('MAX_UPLOAD_BYTES')
+    if isinstance(stream, Spool):
+        tmp_path, digest, size = stream.finish(limit)
+    else:
+        tmp_path, digest, size = _spool(stream, folder, limit)
+
+    upload = Upload.query.filter_by(sha256=digest).first()
+    relative = os.path.join(digest[:2], f'{digest}.pdf')
+    destination = os.path.join(folder, relative)
+    if upload and os.path.exists(destination):
+        os.unlink(tmp_path)
+        return upload
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(tmp_path, destination)
+    if upload:
+        # row survived a lost file, the rename above restored it
+        return upload
+
+    upload = Upload(sha256=digest, path=relative, size=size, name=name, datetime=datetime.now())
+    try:
+        with db.session.begin_nested():
+            db.session.add(upload)
+    except IntegrityError:
+        # the same file was stored concurrently
+        upload = Upload.query.filter_by(sha256=digest).first()
+    return upload
+
+def attach(book, stream, name=None):
+    book.upload = store(stream, name)
+    return book.upload
+
+def send(upload, download_name=None):
+    # Range, If-None-Match and If-Modified-Since are answered by werkzeug;
+    # the sha256 is a strong, stable ETag. The body itself is handed to the
+    # front server (X-Accel-Redirect / X-Sendfile) or to the WSGI server's
+    # file_wrapper, which uses sendfile(2).
+    max_age = current_app.config.get('BOOK_CACHE_SECONDS')
+    prefix = current_app.config.get('X_ACCEL_REDIRECT_PREFIX')
+    if prefix:
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + upload.path.replace(os.sep, '/')
+        response.headers['Content-Type'] = 'application/pdf'
+        response.set_etag(upload.sha256)
+        response.last_modified = upload.datetime
+        response.cache_control.private = True
+        response.cache_control.max_age = max_age
+        return response
+    response = send_file(full_path(upload), mimetype='application/pdf', download_name=download_name,
+                         conditional=True, etag=upload.sha256, last_modified=upload.datetime, max_age=max_age)
+    response.cache_control.private = True
+    response.cache_control.public = False
+    return response
+
+def prune():
+    # drop stored files no book points at any more
+    orphans = Upload.query.filter(~Upload.books.any()).all()
+    for upload in orphans:
+        try:
+            os.unlink(full_path(upload))
+        except FileNotFoundError:
+            pass
+        db.session.delete(upload)
+    db.session.commit()
+    return len(orphans)
+
+def init_app(app):
+    app.request_class = UploadRequest
+
+@click.command('storage-prune')
+@with_appcontext
+def storage_prune_command():
+    """Delete stored book files that no book references."""
+    print(f'Removed {prune()} files')
@@ -0,0 +1,43 @@
+#tests/conftest.py
+import os
+import sys
+from datetime import datetime
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from main import create_app
+
+# apps are built with the test profile (strict query budgets, no rate
+# limits) on a throwaway SQLite file per test
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    def make(uri=None, **settings):
+        monkeypatch.setattr(config.TestingConfig, 'SECRET_KEY', 'test')
+        monkeypatch.setattr(config.TestingConfig, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+        monkeypatch.setattr(config.TestingConfig, 'SQLALCHEMY_DATABASE_URI', uri or f'sqlite:///{tmp_path / "test.sqlite3"}')
+        for name, value in settings.items():
+            monkeypatch.setattr(config.TestingConfig, name, value, raising=False)
+        return create_app('test')
+    return make
+
+def seed_library(books=3, username='reader', password='secret'):
+    # a reader and one section of books on a bootstrapped database
+    import bootstrap
+    from werkzeug.security import generate_password_hash
+    from models import db, User, Section, Book
+    import search
+    bootstrap.bootstrap()
+    user = User(username=username, passhash=generate_password_hash(password), name='Reader')
+    section = Section(name='Fiction', date_created=datetime.now(), description='d')
+    db.session.add(user)
+    db.session.add_all(Book(name=f'Book {index}', content='c', author='Author', price=10 + index, section=section)
+                       for index in range(books))
+    db.session.commit()
+    search.rebuild()
+    return user.id
+
+def login(client, username='reader', password='secret'):
+    return client.post('/login', data={'userName': username, 'password': password})
@@ -0,0 +1,30 @@
+#tests/test_analytics.py
+from datetime import date, timedelta
+from models import db, Cart, Issue
+from conftest import seed_library
+from checkout import checkout_cart
+import analytics
+import jobs
+import versions
+
+def test_stats_follow_writes_made_elsewhere(make_app):
+    # checkout_cart and the jobs run without touching this process' cache,
+    # the way another worker or the jobs process would
+    app = make_app()
+    with app.app_context():
+        user_id = seed_library()
+        assert analytics.section_stats()['totals']['orders'] == 0
+
+        db.session.add(Cart(user_id=user_id, book_id=1, quantity=2))
+        db.session.commit()
+        shared = versions.get_many(versions.CATALOGUE, versions.ISSUES, versions.ARCHIVE)
+        checkout_cart(user_id)
+        # checkouts don't serialize on a shared counter row
+        assert versions.get_many(versions.CATALOGUE, versions.ISSUES, versions.ARCHIVE) == shared
+        totals = analytics.section_stats()['totals']
+        assert (totals['orders'], totals['active_issues']) == (1, 1)
+
+        db.session.execute(db.update(Issue).values(return_date=date.today() - timedelta(days=1)))
+        db.session.commit()
+        jobs.expire_issues()
+        assert analytics.section_stats()['totals']['active_issues'] == 0
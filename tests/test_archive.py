@@ -0,0 +1,39 @@
+#tests/test_archive.py
+import re
+from datetime import datetime, timedelta
+from models import db, Transaction, Payment, Issue, ArchivedTransaction
+from conftest import seed_library, login
+import archive
+
+def test_archiving_keeps_session_cart_valid(make_app):
+    app = make_app(CART_MODE='session')
+    with app.app_context():
+        seed_library()
+    client = app.test_client()
+    login(client)
+    for book_id in (1, 3):
+        client.post(f'/add_to_cart/{book_id}', data={'quantity': '1'})
+        client.post('/checkout')
+    with app.app_context():
+        # make those orders old, paid and returned
+        db.session.execute(db.update(Transaction).values(datetime=datetime.now() - timedelta(days=400)))
+        db.session.execute(db.update(Payment).values(status='success'))
+        db.session.execute(db.update(Issue).values(access=False))
+        db.session.commit()
+
+    client.post('/add_to_cart/2', data={'quantity': '1'})
+    assert client.get('/cart').status_code == 200
+    with app.app_context():
+        # the newest transaction stays so its id is never handed out again
+        assert archive.archive_old_transactions(days=365) == 1
+    response = client.post('/checkout')
+    assert '/payments/' in response.location
+    with app.app_context():
+        assert Transaction.query.count() == 2
+        assert ArchivedTransaction.query.count() == 1
+    page = client.get('/orders').data
+    assert re.findall(rb'Transaction #(\d+)', page) == [b'3', b'2', b'1']
+    # the list is drawn from the stored totals, lines only for the opened transaction
+    assert b'Book 0' not in page
+    assert b'Book 0' in client.get('/orders?open=1').data
+    assert b'Book 2' in client.get('/orders?open=2').data
@@ -0,0 +1,29 @@
+#tests/test_bulk.py
+import io
+from models import db, Book
+from conftest import seed_library
+
+def post_csv(client, body):
+    return client.post('/book/import', data={'file': (io.BytesIO(body), 'books.csv')},
+                       headers={'Accept': 'application/json'})
+
+def test_bad_rows_are_reported_not_raised(make_app):
+    app = make_app()
+    with app.app_context():
+        seed_library(books=1)
+    admin = app.test_client()
+    admin.post('/admin_login', data={'username': 'librarian', 'password': 'admin'})
+
+    response = post_csv(admin, b'name,author,content,price,section\n'
+                               b'Good,A,About,12,Fiction\n'
+                               b'Free,A,About,nan,Fiction\n'
+                               b'Huge,A,About,inf,Fiction\n'
+                               b'Also good,A,About,9.5,Fiction\n'
+                               b'Caf\xe9,A,About,5,Fiction\n'
+                               b'Never read,A,About,5,Fiction\n')
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report['inserted'] == 2 and report['failed'] == 3
+    assert [error['line'] for error in report['errors']] == [3, 4, 6]
+    with app.app_context():
+        assert sorted(db.session.scalars(db.select(Book.name))) == ['Also good', 'Book 0', 'Good']
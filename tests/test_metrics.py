@@ -0,0 +1,15 @@
+#tests/test_metrics.py
+
+def test_slow_log_needs_a_token(make_app):
+    client = make_app().test_client()
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics?slow=1').status_code == 404
+
+    client = make_app(METRICS_TOKEN='t0ken').test_client()
+    assert client.get('/metrics?slow=1').status_code == 401
+    response = client.get('/metrics?slow=1', headers={'Authorization': 'Bearer t0ken'})
+    assert response.status_code == 200 and 'queries' in response.get_json()
+
+def test_metrics_can_require_a_token(make_app):
+    client = make_app(METRICS_REQUIRE_TOKEN=True).test_client()
+    assert client.get('/metrics').status_code == 404
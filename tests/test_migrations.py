@@ -0,0 +1,80 @@
+#tests/test_migrations.py
+import sqlite3
+from click.testing import CliRunner
+from flask.cli import FlaskGroup
+from sqlalchemy import inspect, text
+from models import db
+import bootstrap
+import migrations
+
+# the schema as the first release created it, with a little data
+BASELINE = '''
+CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(32), passhash VARCHAR(256) NOT NULL, name VARCHAR(64),
+    is_admin BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (username));
+CREATE TABLE section (id INTEGER NOT NULL, name VARCHAR(32), date_created DATE NOT NULL,
+    description VARCHAR(2048) NOT NULL, PRIMARY KEY (id), UNIQUE (name));
+CREATE TABLE book (id INTEGER NOT NULL, name VARCHAR(64) NOT NULL, content VARCHAR(2048) NOT NULL,
+    author VARCHAR(64) NOT NULL, price FLOAT NOT NULL, section_id INTEGER NOT NULL, PRIMARY KEY (id),
+    FOREIGN KEY(section_id) REFERENCES section (id));
+CREATE TABLE "transaction" (id INTEGER NOT NULL, user_id INTEGER NOT NULL, datetime DATETIME NOT NULL,
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id));
+CREATE TABLE cart (id INTEGER NOT NULL, user_id INTEGER NOT NULL, book_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(book_id) REFERENCES book (id));
+CREATE TABLE payment (id INTEGER NOT NULL, user_id INTEGER NOT NULL, transaction_id INTEGER NOT NULL,
+    amount_payable INTEGER NOT NULL, status VARCHAR(20) NOT NULL, datetime DATETIME NOT NULL, PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(transaction_id) REFERENCES "transaction" (id));
+CREATE TABLE "order" (id INTEGER NOT NULL, transaction_id INTEGER NOT NULL, book_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL, price FLOAT NOT NULL, PRIMARY KEY (id),
+    FOREIGN KEY(transaction_id) REFERENCES "transaction" (id), FOREIGN KEY(book_id) REFERENCES book (id));
+CREATE TABLE issue (id INTEGER NOT NULL, user_id INTEGER NOT NULL, order_id INTEGER NOT NULL, issue DATE NOT NULL,
+    return_date DATE NOT NULL, access BOOLEAN, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id),
+    FOREIGN KEY(order_id) REFERENCES "order" (id));
+
+INSERT INTO user VALUES (1, 'librarian', 'x', 'Librarian', 1), (2, 'reader', 'x', 'Reader', 0);
+INSERT INTO section VALUES (1, 'Fiction', '2024-01-01', 'd');
+INSERT INTO book VALUES (1, 'Dune', 'c', 'Herbert', 10.0, 1);
+INSERT INTO "transaction" VALUES (1, 2, '2024-01-02 10:00:00');
+INSERT INTO "order" VALUES (1, 1, 1, 2, 10.0);
+INSERT INTO payment VALUES (1, 2, 1, 24, 'pending', '2024-01-02 10:00:00'), (2, 2, 1, 24, 'pending', '2024-01-02 10:01:00');
+INSERT INTO issue VALUES (1, 2, 1, '2024-01-02', '2099-01-09', 1);
+INSERT INTO cart VALUES (1, 2, 1, 1), (2, 2, 1, 2);
+'''
+
+def test_upgrade_from_baseline_schema(make_app, tmp_path):
+    path = tmp_path / 'baseline.sqlite3'
+    connection = sqlite3.connect(path)
+    connection.executescript(BASELINE)
+    connection.close()
+
+    app = make_app(f'sqlite:///{path}')
+    with app.app_context():
+        assert bootstrap.bootstrap() == sorted(version for version, description, func in migrations.migrations)
+        assert bootstrap.bootstrap() == []
+
+        # every column and index of the models is there
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            assert {column.name for column in table.columns} <= columns, table.name
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            assert {index.name for index in table.indexes} <= indexes, table.name
+
+        # and the data was carried over
+        assert db.session.execute(text('SELECT count(*) FROM payment')).scalar() == 1
+        assert db.session.execute(text('SELECT user_id, book_id, quantity FROM cart')).all() == [(2, 1, 3)]
+        assert db.session.execute(text('SELECT copies, available FROM book')).one() == (5, 3)
+        assert db.session.execute(
+            text('SELECT subtotal, item_count FROM "transaction"')).one() == (20.0, 2)
+
+def test_cli_sees_the_database_before_bootstrap(make_app, tmp_path):
+    # BOOTSTRAP_ON_START must not upgrade the database behind db-version / db-upgrade
+    path = tmp_path / 'baseline.sqlite3'
+    connection = sqlite3.connect(path)
+    connection.executescript(BASELINE)
+    connection.close()
+    cli = FlaskGroup(create_app=lambda: make_app(f'sqlite:///{path}', BOOTSTRAP_ON_START=True))
+    runner = CliRunner()
+    latest = migrations.latest_version()
+    assert f'Database version 0, latest {latest}' in runner.invoke(cli, ['db-version']).output
+    assert 'Applied migrations' in runner.invoke(cli, ['db-upgrade']).output
+    assert f'Database version {latest}' in runner.invoke(cli, ['db-version']).output
@@ -0,0 +1,78 @@
+#tests/test_query_budgets.py
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from models import db, Transaction, Order, Issue, Payment
+from conftest import seed_library, login
+
+# the test profile is strict: a view that issues more statements than its
+# @query_budget raises QueryBudgetExceeded, which the client sees as an error
+
+HISTORY = 500
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+def add_history(user_id, count, book_ids):
+    start = datetime.now() - timedelta(days=30)
+    for index in range(count):
+        when = start + timedelta(minutes=index)
+        book_id = book_ids[index % len(book_ids)]
+        transaction_id = db.session.execute(insert(Transaction).returning(Transaction.id), {
+            'user_id': user_id, 'datetime': when, 'subtotal': 10.0, 'gst': 1.8, 'amount_payable': 11.8, 'item_count': 1,
+        }).scalar_one()
+        order_id = db.session.execute(insert(Order).returning(Order.id), {
+            'transaction_id': transaction_id, 'book_id': book_id, 'quantity': 1, 'price': 10.0,
+        }).scalar_one()
+        db.session.execute(insert(Issue), {'user_id': user_id, 'order_id': order_id, 'issue': when.date(),
+                                           'return_date': when.date(), 'access': False})
+        db.session.execute(insert(Payment), {'user_id': user_id, 'transaction_id': transaction_id, 'total': 10.0,
+                                             'gst': 1.8, 'amount_payable': 11.8, 'status': 'success', 'datetime': when})
+    db.session.commit()
+
+def statements(client, url):
+    # statements of the whole request, as reported in Server-Timing
+    response = client.get(url)
+    assert response.status_code == 200, url
+    return int(QUERIES.search(response.headers['Server-Timing']).group(1))
+
+def test_views_stay_within_budget_with_long_history(make_app):
+    app = make_app()
+    with app.app_context():
+        user_id = seed_library(books=20)
+        add_history(user_id, 5, list(range(1, 21)))
+    reader = app.test_client()
+    login(reader)
+    for book_id in (1, 2, 3):
+        reader.post(f'/add_to_cart/{book_id}', data={'quantity': '1'})
+
+    small = {url: statements(reader, url) for url in ('/orders', '/cart', '/user_dash')}
+    with app.app_context():
+        add_history(user_id, HISTORY, list(range(1, 21)))
+    large = {url: statements(reader, url) for url in ('/orders', '/cart', '/user_dash')}
+    assert large == small
+    assert statements(reader, '/orders?before=300') == small['/orders']
+    assert statements(reader, '/orders?open=300') == small['/orders'] + 1
+
+    admin = app.test_client()
+    admin.post('/admin_login', data={'username': 'librarian', 'password': 'admin'})
+    for url in ('/admin_dash', '/admin_dash/analytics', '/section/1/'):
+        assert admin.get(url).status_code == 200, url
+
+def test_payments_budget_covers_missing_and_old_transactions(make_app):
+    app = make_app()
+    with app.app_context():
+        user_id = seed_library()
+        add_history(user_id, 3, [1, 2])
+        # transactions from before payments were written at checkout, one
+        # also from before its totals were stored
+        db.session.execute(db.delete(Payment).where(Payment.transaction_id.in_((2, 3))))
+        db.session.execute(db.update(Transaction).where(Transaction.id == 2).values(subtotal=None))
+        # the payment takes the totals the transaction was stored with
+        db.session.execute(db.update(Transaction).where(Transaction.id == 3).values(gst=1.5, amount_payable=11.5))
+        db.session.commit()
+    reader = app.test_client()
+    login(reader)
+    assert statements(reader, '/payments/1') == 1
+    assert reader.get('/payments/999').status_code == 302
+    assert b'11.8' in reader.get('/payments/2').data
+    assert statements(reader, '/payments/2') == 1
+    assert b'11.5' in reader.get('/payments/3').data
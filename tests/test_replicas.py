@@ -0,0 +1,61 @@
+#tests/test_replicas.py
+from sqlalchemy import event
+from models import db
+from conftest import seed_library, login
+
+def make_replicated_app(make_app, tmp_path, **settings):
+    uris = ','.join(f'sqlite:///{tmp_path / name}' for name in ('replica1.sqlite3', 'replica2.sqlite3'))
+    app = make_app(DB_REPLICA_URIS=uris, **settings)
+    with app.app_context():
+        seed_library()
+    sync(app)
+    used = []
+    with app.app_context():
+        for key, engine in db.engines.items():
+            event.listen(engine, 'before_cursor_execute', lambda *args, key=key: used.append(key or 'primary'))
+    return app, used
+
+def sync(app):
+    result = app.test_cli_runner().invoke(args=['sync-replicas'])
+    assert result.exit_code == 0, result.output
+
+def engines_for(client, used, method, url, **kwargs):
+    used.clear()
+    response = getattr(client, method)(url, **kwargs)
+    assert response.status_code < 400, url
+    return {key if key == 'primary' else 'replica' for key in used}
+
+def test_read_only_views_use_a_replica_until_the_user_writes(make_app, tmp_path):
+    app, used = make_replicated_app(make_app, tmp_path)
+    client = app.test_client()
+    login(client)
+    assert engines_for(client, used, 'get', '/orders') == {'replica'}
+    assert engines_for(client, used, 'get', '/cart') == {'replica'}
+    # writes and views that are not read-only stay on the primary
+    assert engines_for(client, used, 'post', '/add_to_cart/1', data={'quantity': '1'}) == {'primary'}
+    # and the user reads their own write back from the primary
+    assert engines_for(client, used, 'get', '/cart') == {'primary'}
+    with client.session_transaction() as session:
+        assert 'primary_until' in session
+
+def test_read_only_queries_do_not_pin_to_the_primary(make_app, tmp_path):
+    app, used = make_replicated_app(make_app, tmp_path)
+    client = app.test_client()
+    login(client)
+    with client.session_transaction() as session:
+        session.pop('primary_until', None)
+    assert engines_for(client, used, 'get', '/search?q=book') == {'primary'}
+    with client.session_transaction() as session:
+        assert 'primary_until' not in session
+    assert engines_for(client, used, 'get', '/orders') == {'replica'}
+
+def test_session_cart_checkout_with_a_lagging_replica(make_app, tmp_path):
+    # no stickiness and replicas that are only refreshed by sync-replicas
+    app, used = make_replicated_app(make_app, tmp_path, CART_MODE='session', REPLICA_STICKY_SECONDS=0)
+    client = app.test_client()
+    login(client)
+    for book_id in (1, 2):
+        client.post(f'/add_to_cart/{book_id}', data={'quantity': '1'})
+        assert client.get('/cart').status_code == 200
+        response = client.post('/checkout')
+        assert '/payments/' in response.location
@@ -0,0 +1,13 @@
+#tests/test_search.py
+from conftest import seed_library, login
+
+def test_blank_search_terms(make_app):
+    app = make_app()
+    with app.app_context():
+        seed_library()
+    client = app.test_client()
+    login(client)
+    for url in ('/user_dash?bname=%20', '/user_dash?bname=book', '/api/books?q=%20', '/api/books?q=book'):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert b'Book 1' in response.data, url
@@ -0,0 +1,26 @@
+#tests/test_stock.py
+from models import db, Book
+from conftest import seed_library, login
+
+def test_cached_section_table_follows_stock(make_app):
+    app = make_app()
+    with app.app_context():
+        seed_library(books=2)
+        db.session.execute(db.update(Book).where(Book.id == 1).values(copies=1, available=1))
+        db.session.commit()
+    admin = app.test_client()
+    admin.post('/admin_login', data={'username': 'librarian', 'password': 'admin'})
+    page = admin.get('/section/1/').data
+    assert b'1 / 1' in page and b'5 / 5' in page
+
+    reader = app.test_client()
+    login(reader)
+    reader.post('/add_to_cart/1', data={'quantity': '1'})
+    reader.post('/add_to_cart/2', data={'quantity': '1'})
+    reader.post('/checkout')
+    page = admin.get('/section/1/').data
+    # the cached table follows every checkout, not only the ones that sell out a title
+    assert b'0 / 1' in page and b'4 / 5' in page
+    reader.post('/add_to_cart/2', data={'quantity': '1'})
+    reader.post('/checkout')
+    assert b'3 / 5' in admin.get('/section/1/').data
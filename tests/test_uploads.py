@@ -0,0 +1,46 @@
+#tests/test_uploads.py
+import io
+import os
+from models import db, Book
+from conftest import seed_library
+
+PDF = b'%PDF-1.4\n' + b'x' * 100_000
+
+def admin_client(app):
+    client = app.test_client()
+    client.post('/admin_login', data={'username': 'librarian', 'password': 'admin'})
+    return client
+
+def stored_files(app):
+    folder = app.config['UPLOAD_FOLDER']
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, dirs, files in os.walk(folder) for name in files)
+
+def test_form_upload_lands_in_the_store_once(make_app):
+    app = make_app()
+    with app.app_context():
+        seed_library(books=1)
+    client = admin_client(app)
+    response = client.post('/book/1/upload', data={'file': (io.BytesIO(PDF), 'book.pdf')})
+    assert response.status_code == 302
+    files = stored_files(app)
+    # no temporary copy is left behind
+    assert len(files) == 1 and files[0].endswith('.pdf') and not files[0].startswith('tmp')
+    with app.app_context():
+        assert db.session.get(Book, 1).upload.size == len(PDF)
+
+def test_put_errors_have_statuses(make_app):
+    app = make_app(MAX_UPLOAD_BYTES=50_000)
+    with app.app_context():
+        seed_library(books=1)
+    client = admin_client(app)
+    assert client.put('/book/9/upload', data=PDF[:1000]).status_code == 404
+    assert client.put('/book/1/upload', data=b'plain text').status_code == 415
+    assert client.put('/book/1/upload', data=PDF).status_code == 413
+    # chunked: no Content-Length, cut off while reading
+    chunked = client.put('/book/1/upload', input_stream=io.BytesIO(PDF),
+                         environ_overrides={'wsgi.input_terminated': True,
+                                            'HTTP_TRANSFER_ENCODING': 'chunked'})
+    assert chunked.status_code == 413
+    assert client.put('/book/1/upload', data=PDF[:40_000]).status_code == 204
+    assert [name for name in stored_files(app) if name.startswith('tmp')] == []
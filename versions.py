@@ -0,0 +1,56 @@
+#versions.py
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from models import db, Version
+
+# change counters kept in the database so every worker sees the same
+# value. bump() runs inside the caller's transaction, so the counter moves
+# exactly when the write it describes is committed.
+
+CATALOGUE = 'catalogue'
+ISSUES = 'issues'
+# moved by the archive job. Separate from the per user counters, which a
+# session cart claims at checkout and a background job must not move.
+ARCHIVE = 'archive'
+
+def seed():
+    # create the shared counters up front so bump() is one UPDATE for them,
+    # which the checkout query budget counts on
+    existing = {name for name, in db.session.query(Version.name).filter(Version.name.in_((CATALOGUE, ISSUES, ARCHIVE)))}
+    db.session.add_all(Version(name=name, value=0) for name in (CATALOGUE, ISSUES, ARCHIVE) if name not in existing)
+    db.session.commit()
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+def get(name):
+    return db.session.query(Version.value).filter(Version.name == name).scalar() or 0
+
+def get_many(*names):
+    values = dict(db.session.query(Version.name, Version.value).filter(Version.name.in_(names)).all())
+    return tuple(values.get(name, 0) for name in names)
+
+def claim(name, expected):
+    # bump only if the counter still has the expected value; False means
+    # someone else moved it first
+    if expected:
+        statement = update(Version).where(Version.name == name, Version.value == expected) \
+            .values(value=Version.value + 1)
+        return bool(db.session.execute(statement).rowcount)
+    try:
+        with db.session.begin_nested():
+            db.session.add(Version(name=name, value=1))
+    except IntegrityError:
+        return False
+    return True
+
+def bump(name):
+    statement = update(Version).where(Version.name == name).values(value=Version.value + 1)
+    if db.session.execute(statement).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Version(name=name, value=1))
+    except IntegrityError:
+        # created by a concurrent first bump
+        db.session.execute(statement)
@@ -0,0 +1,7 @@
+#wsgi.py
+from main import create_app
+
+# entry point for WSGI servers, e.g. `gunicorn wsgi:app` (settings in
+# gunicorn.conf.py). With preload_app the app is built once in the master
+# and shared by the forked workers.
+app = create_app()